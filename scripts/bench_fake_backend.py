@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Offline stand-in for Ollama and the DeepSeek API, used by bench_gateway.py.
+
+Speaks Ollama's /api/generate, /api/chat, /api/tags, /api/ps and /api/embeddings and
+DeepSeek's /v1/chat/completions and /v1/models. Tokens are paced at a configurable rate
+after a configurable time-to-first-token, and a fraction of requests can fail or stall.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Defaults can also come from the environment so the stub works under a plain `uvicorn` too
+config = {
+    "token_rate": float(os.getenv("FAKE_TOKEN_RATE", "25")),  # generated tokens per second
+    "ttft": float(os.getenv("FAKE_TTFT", "0.2")),  # seconds before the first token
+    "max_tokens": int(os.getenv("FAKE_MAX_TOKENS", "64")),  # reply length when the request sets no limit
+    "parallel": int(os.getenv("FAKE_PARALLEL", "4")),  # concurrent generations, like OLLAMA_NUM_PARALLEL
+    "error_rate": float(os.getenv("FAKE_ERROR_RATE", "0")),  # fraction answered with error_status
+    "error_status": int(os.getenv("FAKE_ERROR_STATUS", "500")),
+    "stall_rate": float(os.getenv("FAKE_STALL_RATE", "0")),  # fraction that hang for `stall` seconds
+    "stall": float(os.getenv("FAKE_STALL_SECONDS", "120")),
+    "jitter": float(os.getenv("FAKE_JITTER", "0.1")),  # +/- fraction applied to ttft and token spacing
+    "seed": os.getenv("FAKE_SEED")
+}
+MODELS = ["tinyllama:latest", "bogdancsn/foundation-sec-8b:latest"]
+WORDS = ("the alert shows repeated authentication failures from a single source address which "
+         "suggests a brute force attempt against the ssh service review the host and block the "
+         "address if the activity continues").split()
+
+app = FastAPI(title="Fake Ollama / DeepSeek backend")
+rng = random.Random(config["seed"])
+gate = asyncio.Semaphore(config["parallel"])
+counters = {"requests": 0, "errors": 0, "stalls": 0, "tokens": 0, "active": 0}
+
+def jittered(seconds: float) -> float:
+    return max(0.0, seconds * (1 + rng.uniform(-config["jitter"], config["jitter"])))
+
+def count_prompt_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def sample_value(schema: Dict[str, Any]) -> Any:
+    """Smallest value that satisfies a JSON schema (enough for the gateway's verdict schemas)"""
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: sample_value(sub) for name, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_value(schema.get("items", {}))] if schema.get("items") else []
+    if kind == "integer":
+        return schema.get("minimum", 1)
+    if kind == "number":
+        return 0.5
+    if kind == "boolean":
+        return False
+    return "stub"
+
+def reply_text(prompt: str, length: int, output_format: Any) -> List[str]:
+    """Reply split into token-sized pieces"""
+    if isinstance(output_format, dict) and output_format.get("type") == "array":
+        # One item per "Alert N:" block, so packed batch prompts get a complete answer
+        numbers = [int(n) for n in re.findall(r"^Alert (\d+):", prompt, re.MULTILINE)] or [1]
+        item = sample_value(output_format.get("items", {}))
+        text = json.dumps([{**item, "index": n} if isinstance(item, dict) else item for n in numbers])
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    if output_format:
+        schema = output_format if isinstance(output_format, dict) else {
+            "type": "object", "properties": {"threat_level": {"enum": ["medium"]}, "summary": {"type": "string"}}}
+        text = json.dumps(sample_value(schema))
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    start = int(hashlib.sha1(prompt.encode()).hexdigest(), 16) % len(WORDS)
+    return [(" " if i else "") + WORDS[(start + i) % len(WORDS)] for i in range(length)]
+
+async def admit() -> Optional[JSONResponse]:
+    """Error injection; None lets the request through"""
+    counters["requests"] += 1
+    roll = rng.random()
+    if roll < config["error_rate"]:
+        counters["errors"] += 1
+        return JSONResponse({"error": "injected failure"}, status_code=config["error_status"])
+    if roll < config["error_rate"] + config["stall_rate"]:
+        counters["stalls"] += 1
+        await asyncio.sleep(config["stall"])
+    return None
+
+async def generate(pieces: List[str]):
+    """Yield (piece, elapsed) at the configured pacing while holding a generation slot"""
+    async with gate:
+        counters["active"] += 1
+        try:
+            await asyncio.sleep(jittered(config["ttft"]))
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(jittered(1 / config["token_rate"]))
+                counters["tokens"] += 1
+                yield piece
+        finally:
+            counters["active"] -= 1
+
+def ollama_stats(prompt: str, tokens: int, started: float) -> Dict[str, Any]:
+    elapsed = time.monotonic() - started
+    ttft = min(config["ttft"], elapsed)
+    return {
+        "done": True,
+        "done_reason": "stop" if tokens < config["max_tokens"] else "length",
+        "total_duration": int(elapsed * 1e9),
+        "load_duration": 0,
+        "prompt_eval_count": count_prompt_tokens(prompt),
+        "prompt_eval_duration": int(ttft * 1e9),
+        "eval_count": tokens,
+        "eval_duration": int(max(elapsed - ttft, 1e-3) * 1e9)
+    }
+
+async def ollama_reply(body: Dict[str, Any], prompt: str, chat: bool):
+    failure = await admit()
+    if failure is not None:
+        return failure
+    options = body.get("options") or {}
+    length = min(int(options.get("num_predict") or config["max_tokens"]), config["max_tokens"])
+    pieces = reply_text(prompt, length, body.get("format"))
+    model = body.get("model", MODELS[0])
+    started = time.monotonic()
+
+    def chunk(piece: str) -> Dict[str, Any]:
+        base = {"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "done": False}
+        if chat:
+            return {**base, "message": {"role": "assistant", "content": piece}}
+        return {**base, "response": piece}
+
+    if body.get("stream", True):
+        async def lines():
+            count = 0
+            async for piece in generate(pieces):
+                count += 1
+                yield json.dumps(chunk(piece)) + "\n"
+            yield json.dumps({**chunk(""), **ollama_stats(prompt, count, started)}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    text = "".join([piece async for piece in generate(pieces)])
+    return {**chunk(text), **ollama_stats(prompt, len(pieces), started)}
+
+@app.post("/api/generate")
+async def api_generate(request: Request):
+    body = await request.json()
+    return await ollama_reply(body, body.get("prompt", ""), chat=False)
+
+@app.post("/api/chat")
+async def api_chat(request: Request):
+    body = await request.json()
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+    return await ollama_reply(body, prompt, chat=True)
+
+@app.get("/api/tags")
+async def api_tags():
+    return {"models": [{"name": name, "model": name, "size": 0} for name in MODELS]}
+
+@app.get("/api/ps")
+async def api_ps():
+    return {"models": [{"name": name, "model": name} for name in MODELS]}
+
+@app.post("/api/embeddings")
+async def api_embeddings(request: Request):
+    """Hashed bag-of-words vector, so near-identical prompts land close together"""
+    body = await request.json()
+    vector = [0.0] * 64
+    for word in str(body.get("prompt", "")).lower().split():
+        vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 64] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return {"embedding": [v / norm for v in vector]}
+
+@app.get("/v1/models")
+async def deepseek_models():
+    return {"object": "list", "data": [{"id": "deepseek-chat", "object": "model", "owned_by": "deepseek"}]}
+
+@app.post("/v1/chat/completions")
+async def deepseek_chat(request: Request):
+    body = await request.json()
+    failure = await admit()
+    if failure is not None:
+        return failure
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+    length = min(int(body.get("max_tokens") or config["max_tokens"]), config["max_tokens"])
+    pieces = reply_text(prompt, length, "json" if json_mode else None)
+    model = body.get("model", "deepseek-chat")
+    created = int(time.time())
+
+    def usage(tokens: int) -> Dict[str, int]:
+        prompt_tokens = count_prompt_tokens(prompt)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+
+    if body.get("stream"):
+        async def events():
+            count = 0
+            async for piece in generate(pieces):
+                count += 1
+                delta = {"object": "chat.completion.chunk", "id": "fake", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield f"data: {json.dumps(delta)}\n\n"
+            final = {"object": "chat.completion.chunk", "id": "fake", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage(count)}
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+    text = "".join([piece async for piece in generate(pieces)])
+    return {
+        "id": "fake", "object": "chat.completion", "created": created, "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": usage(len(pieces))
+    }
+
+@app.get("/bench/stats")
+async def bench_stats():
+    return {**counters, "config": config}
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Fake Ollama / DeepSeek backend for benchmarks")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--token-rate", type=float, default=config["token_rate"], help="Tokens per second")
+    parser.add_argument("--ttft", type=float, default=config["ttft"], help="Seconds to first token")
+    parser.add_argument("--max-tokens", type=int, default=config["max_tokens"], help="Reply length cap")
+    parser.add_argument("--parallel", type=int, default=config["parallel"], help="Concurrent generations")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"], help="Fraction of failed requests")
+    parser.add_argument("--error-status", type=int, default=config["error_status"])
+    parser.add_argument("--stall-rate", type=float, default=config["stall_rate"], help="Fraction of stalled requests")
+    parser.add_argument("--stall", type=float, default=config["stall"], help="Seconds a stalled request hangs")
+    parser.add_argument("--jitter", type=float, default=config["jitter"])
+    parser.add_argument("--seed", default=config["seed"])
+    args = parser.parse_args()
+    config.update({key: value for key, value in vars(args).items() if key != "port"})
+    rng.seed(config["seed"])
+    gate = asyncio.Semaphore(config["parallel"])
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
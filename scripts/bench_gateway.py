@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Open-loop load generator for foundation_sec_api_lite.py.
+
+Sends requests at a target rate for a fixed duration and prints a JSON report with
+latency percentiles, time to first token, throughput and error rates. With --spawn it
+starts bench_fake_backend.py and a gateway pointed at it, so the whole run is offline:
+
+    python scripts/bench_gateway.py --spawn --rps 20 --duration 30 --scenario mix
+    python scripts/bench_gateway.py --url http://localhost:8000 --rps 5 --scenario verdict
+
+--max-p95-ms and --max-error-rate turn the report into a pass/fail check (exit status 1).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("chat", "stream", "verdict", "analyze")
+RULES = [
+    (5710, 5, "sshd: Attempt to login using a non-existent user"),
+    (5712, 10, "sshd: brute force trying to get access to the system"),
+    (31103, 7, "SQL injection attempt"),
+    (550, 7, "Integrity checksum changed"),
+    (100002, 13, "Suspicious PowerShell execution"),
+]
+
+def make_alert(rng: random.Random, unique: bool) -> Dict[str, Any]:
+    rule_id, level, description = rng.choice(RULES)
+    agent = rng.randint(1, 5)
+    source_ip = f"203.0.113.{rng.randint(1, 254) if unique else agent}"
+    pid = rng.randint(1000, 9999) if unique else 1000 + agent
+    return {
+        "id": f"{time.time():.6f}-{rng.random():.6f}",
+        "rule": {"id": str(rule_id), "level": level, "description": description},
+        "agent": {"id": f"{agent:03d}", "name": f"host-{agent}", "ip": f"10.0.0.{agent}"},
+        "data": {"srcip": source_ip},
+        "full_log": f"sshd[{pid}]: {description} from {source_ip} port 22"
+    }
+
+def build_request(scenario: str, rng: random.Random, unique_ratio: float,
+                  max_tokens: int) -> Tuple[str, Dict[str, Any], bool]:
+    """(path, body, streamed) for one request; repeated bodies exercise the caches"""
+    unique = rng.random() < unique_ratio
+    if scenario == "verdict":
+        return "/v1/verdict", {"alert": make_alert(rng, unique), "priority": "high"}, False
+    if scenario == "analyze":
+        return "/alerts/analyze", {"alerts": [make_alert(rng, unique) for _ in range(8)]}, False
+    question = rng.randint(0, 10 ** 9) if unique else rng.randint(0, 19)
+    body = {
+        "model": "foundation-sec",
+        "messages": [{"role": "user", "content": f"Explain security event #{question} in two sentences."}],
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "priority": "interactive" if scenario == "stream" else "standard",
+        "stream": scenario == "stream"
+    }
+    return "/v1/chat/completions", body, scenario == "stream"
+
+async def send(client: httpx.AsyncClient, scenario: str, path: str, body: Dict[str, Any],
+               streamed: bool) -> Dict[str, Any]:
+    record: Dict[str, Any] = {"scenario": scenario, "status": None, "error": None, "ttft": None}
+    started = time.perf_counter()
+    try:
+        if streamed:
+            async with client.stream("POST", path, json=body) as response:
+                record["status"] = response.status_code
+                record["cache"] = response.headers.get("X-Cache")
+                async for chunk in response.aiter_bytes():
+                    if record["ttft"] is None and chunk.strip():
+                        record["ttft"] = time.perf_counter() - started
+        else:
+            response = await client.post(path, json=body)
+            record["status"] = response.status_code
+            record["cache"] = response.headers.get("X-Cache")
+            if response.headers.get("X-Degraded"):
+                record["cache"] = "DEGRADED"
+        if record["status"] >= 400:
+            record["error"] = str(record["status"])
+    except httpx.TimeoutException:
+        record["error"] = "timeout"
+    except httpx.HTTPError as e:
+        record["error"] = type(e).__name__
+    record["latency"] = time.perf_counter() - started
+    return record
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile in milliseconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[rank] * 1000, 1)
+
+def summarize(records: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in records if r["error"] is None]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    return {
+        "requests": len(records),
+        "succeeded": len(ok),
+        "errors": dict(Counter(r["error"] for r in records if r["error"] is not None)),
+        "error_rate": round(1 - len(ok) / len(records), 4) if records else 0.0,
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(max(latencies) * 1000, 1) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None
+        },
+        "ttft_ms": {"p50": percentile(ttfts, 50), "p95": percentile(ttfts, 95), "p99": percentile(ttfts, 99)}
+                   if ttfts else None,
+        "cache": dict(Counter(r.get("cache") or "none" for r in ok))
+    }
+
+async def run_load(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    scenarios = SCENARIOS if args.scenario == "mix" else (args.scenario,)
+    timeout = httpx.Timeout(args.timeout, connect=5.0)
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+        if args.warmup:
+            for scenario in scenarios:
+                await send(client, scenario, *build_request(scenario, rng, 1.0, args.max_tokens))
+
+        tasks: List[asyncio.Task] = []
+        total = int(args.rps * args.duration)
+        started = time.perf_counter()
+        for i in range(total):
+            # Open loop: the send schedule does not wait for earlier responses
+            delay = started + i / args.rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scenario = scenarios[i % len(scenarios)]
+            path, body, streamed = build_request(scenario, rng, args.unique_ratio, args.max_tokens)
+            tasks.append(asyncio.create_task(send(client, scenario, path, body, streamed)))
+        offered = time.perf_counter() - started
+        records = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        gateway: Optional[Dict[str, Any]] = None
+        try:
+            stats = (await client.get("/stats")).json()
+            gateway = {key: stats.get(key) for key in ("cache", "scheduler", "admission", "singleflight") if key in stats}
+        except (httpx.HTTPError, ValueError):
+            pass
+
+    report = {
+        "target": args.url,
+        "scenario": args.scenario,
+        "target_rps": args.rps,
+        "offered_rps": round(total / offered, 2) if offered else None,
+        "duration_seconds": round(elapsed, 2),
+        **summarize(records, elapsed),
+        "by_scenario": {name: summarize([r for r in records if r["scenario"] == name], elapsed)
+                        for name in scenarios},
+        "gateway": gateway
+    }
+    return report
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(url: str, deadline: float) -> None:
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+def spawn(args: argparse.Namespace, workdir: str) -> List[subprocess.Popen]:
+    """Start the fake backend and a gateway on free ports; sets args.url"""
+    backend_port, gateway_port = free_port(), free_port()
+    backend = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS_DIR, "bench_fake_backend.py"), "--port", str(backend_port),
+         "--token-rate", str(args.token_rate), "--ttft", str(args.ttft), "--parallel", str(args.backend_parallel),
+         "--error-rate", str(args.error_rate), "--stall-rate", str(args.stall_rate), "--seed", str(args.seed)])
+    backend_url = f"http://127.0.0.1:{backend_port}"
+    env = {
+        **os.environ,
+        "OLLAMA_URL": backend_url,
+        "OLLAMA_URLS": backend_url,
+        "DEEPSEEK_BASE_URL": backend_url,
+        "DEEPSEEK_API_KEY": "bench",
+        "ALERT_LOG_DIR": os.path.join(workdir, "alert-buffer"),
+        "VERDICT_STORE_PATH": os.path.join(workdir, "verdict-store", "verdicts.db"),
+        "SEMANTIC_CACHE_DIR": os.path.join(workdir, "semantic-cache"),
+        "OLLAMA_CONCURRENCY": str(args.backend_parallel)
+    }
+    for item in args.gateway_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS_DIR, "foundation_sec_api_lite.py"), "--port", str(gateway_port)],
+        env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "gateway.log"), "w"))
+    args.url = f"http://127.0.0.1:{gateway_port}"
+    try:
+        wait_for(f"{backend_url}/api/tags", time.monotonic() + 15)
+        wait_for(f"{args.url}/health", time.monotonic() + 30)
+    except RuntimeError:
+        for process in (gateway, backend):
+            process.terminate()
+        raise
+    return [gateway, backend]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test foundation_sec_api_lite.py")
+    parser.add_argument("--url", default="http://localhost:8000", help="Gateway base URL (ignored with --spawn)")
+    parser.add_argument("--rps", type=float, default=10, help="Target requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("mix",), default="chat")
+    parser.add_argument("--unique-ratio", type=float, default=0.5,
+                        help="Fraction of requests with a fresh body; the rest repeat and can hit the caches")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--warmup", action="store_true", help="Send one request per scenario before measuring")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="Fail if p95 latency is higher")
+    parser.add_argument("--max-error-rate", type=float, help="Fail if the error rate is higher")
+    spawned = parser.add_argument_group("--spawn: run the gateway against bench_fake_backend.py")
+    spawned.add_argument("--spawn", action="store_true")
+    spawned.add_argument("--token-rate", type=float, default=25)
+    spawned.add_argument("--ttft", type=float, default=0.2)
+    spawned.add_argument("--backend-parallel", type=int, default=4)
+    spawned.add_argument("--error-rate", type=float, default=0.0)
+    spawned.add_argument("--stall-rate", type=float, default=0.0)
+    spawned.add_argument("--gateway-env", action="append", default=[], metavar="KEY=VALUE",
+                         help="Extra gateway environment, e.g. CACHE_ENABLED=false (repeatable)")
+    args = parser.parse_args()
+
+    processes: List[subprocess.Popen] = []
+    with tempfile.TemporaryDirectory(prefix="gateway-bench-") as workdir:
+        try:
+            if args.spawn:
+                processes = spawn(args, workdir)
+            report = asyncio.run(run_load(args))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    failures = []
+    if args.max_p95_ms is not None and (report["latency_ms"]["p95"] or 0) > args.max_p95_ms:
+        failures.append(f"p95 {report['latency_ms']['p95']} ms > {args.max_p95_ms} ms")
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']} > {args.max_error_rate}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+CPU precision benchmark for foundation_sec_api.py.
+
+Loads the model once per precision, decodes the calibration prompt greedily with each
+and prints a JSON report: tokens per second, weight bytes, speedup over bf16 and the
+share of greedy tokens identical to bf16's. int8 is converted in memory with the
+server's own quantize_model, so the numbers match what MODEL_PRECISION=int8 serves:
+
+    python scripts/bench_precision.py --model fdtn-ai/Foundation-Sec-8B-Instruct --tokens 64
+    python scripts/bench_precision.py --model ./tiny-llama --precisions bf16 int8 --output precision.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DTYPES = {"fp32": "float32", "bf16": "bfloat16", "fp16": "float16"}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "fdtn-ai/Foundation-Sec-8B-Instruct"))
+    parser.add_argument("--precisions", nargs="+", default=["bf16", "int8"], choices=["fp32", "fp16", "bf16", "int8"])
+    parser.add_argument("--tokens", type=int, default=32, help="greedy tokens decoded per precision")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    os.environ["MODEL_NAME"] = args.model
+    os.environ["CALIBRATION_TOKENS"] = str(args.tokens)
+    sys.path.insert(0, SCRIPTS_DIR)
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import foundation_sec_api as api
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    results = {}
+    for precision in args.precisions:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model,
+            torch_dtype=getattr(torch, DTYPES.get(precision, "bfloat16")),
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+            device_map="cpu"
+        ).eval()
+        if precision == "int8":
+            model = api.quantize_model(model).eval()
+        results[precision] = api.measure(model, tokenizer, precision)
+        del model
+        gc.collect()
+
+    baseline = results.get("bf16") or next(iter(results.values()))
+    for result in results.values():
+        result["speedup"] = round(result["tokens_per_second"] / baseline["tokens_per_second"], 3)
+        result["greedy_agreement"] = round(
+            sum(a == b for a, b in zip(result["tokens"], baseline["tokens"])) / args.tokens, 3)
+    report = {
+        "model": args.model,
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "baseline": baseline["precision"],
+        "results": [{k: v for k, v in r.items() if k != "tokens"} for r in results.values()]
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
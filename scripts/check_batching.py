@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Greedy equivalence check for the batching engine in foundation_sec_api.py.
+
+Builds a tiny random Llama (no download), decodes prompts of different lengths through
+BatchEngine — a first batch, a second batch merged into it mid-decode, rows retiring at
+different lengths — and compares every sequence with single-sequence model.generate().
+Left padding, cache merging and trimming must not change a single greedy token:
+
+    python scripts/check_batching.py
+    python scripts/check_batching.py --seed 3 --tokens 24
+
+Exits with status 1 on the first mismatch.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def tiny_model_and_tokenizer(seed: int):
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    words = ["<pad>", "<eos>", "<unk>"] + [f"w{i}" for i in range(253)]
+    backend = Tokenizer(models.WordLevel({word: i for i, word in enumerate(words)}, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="<pad>", eos_token="<eos>",
+                                        unk_token="<unk>")
+    config = LlamaConfig(vocab_size=len(words), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+                         pad_token_id=0, bos_token_id=2, eos_token_id=1)
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(config).eval(), tokenizer
+
+async def check(seed: int, tokens: int) -> int:
+    import torch
+    sys.path.insert(0, SCRIPTS_DIR)
+    import foundation_sec_api as api
+
+    model, tokenizer = tiny_model_and_tokenizer(seed)
+    engine = api.BatchEngine(model, tokenizer, max_batch=8, max_wait=0)
+    generator = torch.Generator().manual_seed(seed)
+
+    def sequence(length: int, max_new_tokens: int) -> api.Sequence:
+        prompt = torch.randint(3, model.config.vocab_size, (length,), generator=generator).tolist()
+        return api.Sequence(prompt, max_new_tokens, temperature=0.0, top_p=1.0)
+
+    first = [sequence(5, tokens), sequence(11, tokens // 2), sequence(8, tokens)]
+    second = [sequence(14, tokens), sequence(3, tokens // 3)]
+    finished = list(engine._step(first))
+    for _ in range(3):
+        finished += engine._step([])
+    finished += engine._step(second)
+    while engine.active:
+        finished += engine._step([])
+
+    mismatches = []
+    for index, seq in enumerate(first + second):
+        with torch.inference_mode():
+            output = model.generate(torch.tensor([seq.prompt_ids]), max_new_tokens=seq.max_new_tokens,
+                                    do_sample=False, eos_token_id=sorted(engine.eos_ids),
+                                    pad_token_id=engine.pad_id)
+        expected = output[0, len(seq.prompt_ids):].tolist()
+        if seq not in finished or seq.generated != expected:
+            mismatches.append({"sequence": index, "prompt_tokens": len(seq.prompt_ids),
+                               "batched": seq.generated, "generate": expected})
+    print(json.dumps({"seed": seed, "sequences": len(first + second), "mismatches": mismatches}, indent=2))
+    return 1 if mismatches else 0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokens", type=int, default=16, help="max new tokens for the longest sequences")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(check(args.seed, args.tokens)))
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import logging
 import asyncio
-from typing import Dict, List, Optional
+import itertools
+import resource
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, TextStreamer
+from transformers.cache_utils import Cache, DynamicCache
 import uvicorn
 
 # Configure logging
@@ -19,7 +29,62 @@ logger = logging.getLogger(__name__)
 # Global variables for model and tokenizer
 model = None
 tokenizer = None
-text_generator = None
+engine = None
+calibration_report = None
+
+# Model and CPU precision: auto | fp32 | fp16 | bf16 | int8 (CUDA always loads fp16)
+model_name = os.getenv("MODEL_NAME", "fdtn-ai/Foundation-Sec-8B-Instruct")
+model_precision = os.getenv("MODEL_PRECISION", "auto").lower()  # auto = int8 on CPU, logged as a warning
+quantized_cache_dir = os.getenv("QUANTIZED_CACHE_DIR", "quantized-cache")
+calibrate_on_convert = os.getenv("CALIBRATE", "true").lower() == "true"
+calibration_tokens = int(os.getenv("CALIBRATION_TOKENS", "32"))
+memory_budget_bytes = 8 * 1024 ** 3  # the max_memory budget the CPU loader asks for
+
+# Batching: concurrent requests are decoded together, one token per sequence per step
+batch_max_size = int(os.getenv("BATCH_MAX_SIZE", "4"))
+batch_max_wait = float(os.getenv("BATCH_MAX_WAIT_MS", "20")) / 1000  # gather window when the engine is idle
+sampling_top_k = 50  # transformers' generate() default, kept from the pipeline
+
+# Admission and deadlines: generation runs on one dedicated thread behind a bounded queue
+generation_queue_size = int(os.getenv("GENERATION_QUEUE_SIZE", "16"))  # waiting requests before 503
+generation_timeout = float(os.getenv("GENERATION_TIMEOUT", "300"))  # seconds per request, queue wait included
+generation_retry_after = int(os.getenv("GENERATION_RETRY_AFTER", "10"))
+generation_max_time = float(os.getenv("GENERATION_MAX_TIME", "0"))  # default per-request decode budget; 0 = none
+default_max_tokens = 512  # when a request omits max_tokens or sends null
+# End-of-turn / end-of-text markers used by Llama 3 chat models, in addition to the configured EOS ids
+STOP_TOKENS = ("<|eot_id|>", "<|end_of_text|>", "<|eom_id|>")
+disconnect_poll_interval = 0.5
+
+# CPU threads: every batched step runs on the single generation thread, so torch's intra-op pool
+# gets all available cores and inter-op parallelism stays off to avoid oversubscription
+available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+torch_threads = int(os.getenv("TORCH_THREADS", str(available_cores)))
+torch_interop_threads = int(os.getenv("TORCH_INTEROP_THREADS", "1"))
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")  # tokenization runs on the event loop thread
+torch.set_num_threads(torch_threads)
+try:
+    torch.set_num_interop_threads(torch_interop_threads)
+except RuntimeError:
+    # Only allowed before any inter-op work has started (e.g. when imported by another process)
+    logger.warning("Inter-op thread count already fixed; TORCH_INTEROP_THREADS ignored")
+
+# Prometheus metrics
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+REQUESTS = Counter("foundation_requests_total", "Generation requests", ["endpoint", "status"])
+REQUEST_LATENCY = Histogram("foundation_request_duration_seconds", "Generation latency",
+                            ["endpoint"], buckets=LATENCY_BUCKETS)
+TOKENS = Counter("foundation_tokens_total", "Prompt and generated tokens", ["kind"])
+TOKENS_PER_SECOND = Histogram("foundation_completion_tokens_per_second",
+                              "Decode speed per request, from the first generated token",
+                              buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200))
+TIME_TO_FIRST_TOKEN = Histogram("foundation_time_to_first_token_seconds",
+                                "Request arrival to first generated token (queue wait and prefill)",
+                                ["endpoint"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge("foundation_requests_in_flight", "Generation requests currently running")
+MODEL_LOADED = Gauge("foundation_model_loaded", "1 once the model and tokenizer are loaded")
+QUEUE_DEPTH = Gauge("foundation_queue_depth", "Requests waiting to join the running batch")
+BATCH_SIZE = Histogram("foundation_batch_size", "Sequences per decode step", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+MODEL_BYTES = Gauge("foundation_model_bytes", "Memory held by model weights after quantization")
 
 class ChatMessage(BaseModel):
     role: str
@@ -27,9 +92,12 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
-    max_tokens: Optional[int] = 512
+    max_tokens: Optional[int] = default_max_tokens
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    stream: Optional[bool] = False
+    stop: Optional[Union[str, List[str]]] = None  # stop strings; generation ends before the first match
+    max_time: Optional[float] = None  # seconds of decoding before finishing with "time"
 
 class ChatResponse(BaseModel):
     choices: List[Dict]
@@ -41,9 +109,11 @@ async def lifespan(app: FastAPI):
     logger.info("Loading Foundation-Sec-8B-Instruct model...")
     await load_model()
     logger.info("Model loaded successfully!")
+    engine.start()
     yield
     # Shutdown
     logger.info("Shutting down...")
+    await engine.stop()
 
 app = FastAPI(
     title="Foundation-Sec-8B API",
@@ -52,15 +122,557 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+class QueueFullError(Exception):
+    pass
+
+class AsyncTextStreamer(TextStreamer):
+    """Token-iterator streamer that hands decoded text from the generation thread to the event loop.
+
+    Text arrives in word-sized pieces on `queue`; None marks the end of the stream.
+    """
+
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer, skip_prompt=False, skip_special_tokens=True)
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+class Sequence:
+    """One request inside the batching engine"""
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: Optional[int], temperature: float, top_p: float,
+                 streamer: Optional[AsyncTextStreamer] = None, stop: Optional[List[str]] = None,
+                 max_time: Optional[float] = None):
+        self.prompt_ids = prompt_ids
+        self.streamer = streamer
+        self.stop = [text for text in (stop or []) if text]
+        # Tokens to re-decode when looking for stop strings; a token decodes to at least one character
+        self.stop_window = max((len(text) for text in self.stop), default=0) + 2
+        self.max_time = max_time if max_time is not None else (generation_max_time or None)
+        self.first_token_at: Optional[float] = None  # monotonic time the prefill sampled the first token
+        self.max_new_tokens = max(1, max_new_tokens if max_new_tokens is not None else default_max_tokens)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.future = asyncio.get_running_loop().create_future()
+
+class BatchEngine:
+    """Continuous batching over a left-padded KV cache.
+
+    A worker coroutine gathers queued requests (up to `max_batch`, waiting at most `max_wait`
+    when idle) and runs prefill and decode steps on a dedicated generation thread. New
+    sequences are prefilled and merged into the running batch between decode steps, and
+    finished ones are dropped from it, so the batch refills without waiting for the slowest.
+    """
+
+    def __init__(self, model, tokenizer, max_batch: int, max_wait: float):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.device = model.device
+        self.eos_ids = stop_token_ids(model, tokenizer)
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=generation_queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate",
+                                            initializer=torch.set_num_threads, initargs=(torch_threads,))
+        self._worker: Optional[asyncio.Task] = None
+        # Batch state, only touched on the generation thread; row i belongs to active[i]
+        self.active: List[Sequence] = []
+        self.cache = None  # legacy format: per layer (key, value), each (batch, heads, length, head_dim)
+        self.mask = None  # (batch, length); 0 marks left padding
+        self.positions = None  # (batch,) position id of the next input token
+        self.next_tokens = None  # (batch,) last sampled token, fed to the next decode step
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for sequence in self.active:
+            if not sequence.future.done():
+                sequence.future.cancel()
+        while not self.queue.empty():
+            self.queue.get_nowait().future.cancel()
+
+    def submit(self, sequence: Sequence) -> None:
+        """Queue a sequence without waiting; raises QueueFullError when the queue is at its bound"""
+        try:
+            self.queue.put_nowait(sequence)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"{self.queue.qsize()} requests already waiting")
+        QUEUE_DEPTH.set(self.queue.qsize())
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active_sequences": len(self.active), "queued": self.queue.qsize(),
+                "queue_limit": self.queue.maxsize, "max_batch": self.max_batch}
+
+    async def _admit(self) -> List[Sequence]:
+        admitted: List[Sequence] = []
+        if not self.active:
+            admitted.append(await self.queue.get())
+            deadline = time.monotonic() + self.max_wait
+            while len(admitted) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    admitted.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        while len(self.active) + len(admitted) < self.max_batch and not self.queue.empty():
+            admitted.append(self.queue.get_nowait())
+        QUEUE_DEPTH.set(self.queue.qsize())
+        # Callers that went away before their turn are never prefilled
+        return [sequence for sequence in admitted if not sequence.future.done()]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            admitted = await self._admit()
+            if not admitted and not self.active:
+                continue
+            try:
+                finished = await loop.run_in_executor(self._executor, self._step, admitted)
+            except Exception as e:
+                logger.error(f"Generation step failed: {str(e)}")
+                for sequence in dict.fromkeys(self.active + admitted):
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+                    if sequence.streamer:
+                        sequence.streamer.end()
+                self._reset()
+                continue
+            for sequence in finished:
+                if not sequence.future.done():
+                    sequence.future.set_result(sequence)
+
+    def _reset(self) -> None:
+        self.active, self.cache, self.mask, self.positions, self.next_tokens = [], None, None, None, None
+
+    @torch.inference_mode()
+    def _step(self, admitted: List[Sequence]) -> List[Sequence]:
+        if admitted:
+            self._prefill(admitted)
+        else:
+            self._decode()
+        BATCH_SIZE.observe(len(self.active))
+        return self._retire()
+
+    def _prefill(self, sequences: List[Sequence]) -> None:
+        length = max(len(s.prompt_ids) for s in sequences)
+        input_ids = torch.full((len(sequences), length), self.pad_id, dtype=torch.long)
+        mask = torch.zeros((len(sequences), length), dtype=torch.long)
+        for row, sequence in enumerate(sequences):
+            input_ids[row, length - len(sequence.prompt_ids):] = torch.tensor(sequence.prompt_ids)
+            mask[row, length - len(sequence.prompt_ids):] = 1
+        input_ids, mask = input_ids.to(self.device), mask.to(self.device)
+        outputs = self.model(input_ids=input_ids, attention_mask=mask,
+                             position_ids=(mask.cumsum(-1) - 1).clamp(min=0), use_cache=True)
+        cache = legacy_cache(outputs.past_key_values)
+        tokens = self._sample(outputs.logits[:, -1, :], sequences)
+        positions = torch.tensor([len(s.prompt_ids) for s in sequences], device=self.device)
+        if not self.active:
+            self.active, self.cache, self.mask = list(sequences), cache, mask
+            self.positions, self.next_tokens = positions, tokens
+            return
+        # Left-pad the shorter side so both caches share one length, then stack the rows
+        total = max(self.mask.shape[1], length)
+        self.cache = tuple(
+            tuple(torch.cat([F.pad(old, (0, 0, total - old.shape[2], 0)), F.pad(new, (0, 0, total - new.shape[2], 0))])
+                  for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self.cache, cache))
+        self.mask = torch.cat([F.pad(self.mask, (total - self.mask.shape[1], 0)), F.pad(mask, (total - length, 0))])
+        self.positions = torch.cat([self.positions, positions])
+        self.next_tokens = torch.cat([self.next_tokens, tokens])
+        self.active.extend(sequences)
+
+    def _decode(self) -> None:
+        mask = torch.cat([self.mask, self.mask.new_ones((self.mask.shape[0], 1))], dim=1)
+        outputs = self.model(input_ids=self.next_tokens[:, None], attention_mask=mask,
+                             position_ids=self.positions[:, None], past_key_values=model_cache(self.model, self.cache),
+                             use_cache=True)
+        self.cache, self.mask = legacy_cache(outputs.past_key_values), mask
+        self.positions = self.positions + 1
+        self.next_tokens = self._sample(outputs.logits[:, -1, :], self.active)
+
+    def _sample(self, logits: torch.Tensor, sequences: List[Sequence]) -> torch.Tensor:
+        """Per-row temperature, top-k and top-p sampling; temperature 0 decodes greedily"""
+        logits = logits.float()
+        temperature = torch.tensor([max(s.temperature or 0.0, 1e-5) for s in sequences], device=logits.device)
+        top_p = torch.tensor([s.top_p if s.top_p is not None else 1.0 for s in sequences], device=logits.device)
+        scaled = logits / temperature[:, None]
+        kth = torch.topk(scaled, min(sampling_top_k, scaled.shape[-1]), dim=-1).values[:, -1:]
+        probs = torch.softmax(scaled.masked_fill(scaled < kth, float("-inf")), dim=-1)
+        sorted_probs, order = torch.sort(probs, descending=True, dim=-1)
+        sorted_probs = sorted_probs.masked_fill(sorted_probs.cumsum(-1) - sorted_probs > top_p[:, None], 0.0)
+        sampled = order.gather(1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+        greedy = torch.tensor([not s.temperature for s in sequences], device=logits.device)
+        tokens = torch.where(greedy, logits.argmax(-1), sampled)
+        now = time.monotonic()
+        for sequence, token in zip(sequences, tokens.tolist()):
+            if not sequence.generated:
+                sequence.first_token_at = now
+            sequence.generated.append(token)
+            if sequence.streamer:
+                sequence.streamer.put(torch.tensor([token]))
+        return tokens
+
+    def _retire(self) -> List[Sequence]:
+        """Remove finished rows from the batch and trim padding no remaining row needs"""
+        finished, keep = [], []
+        now = time.monotonic()
+        for row, sequence in enumerate(self.active):
+            if sequence.generated[-1] in self.eos_ids or self._hit_stop_string(sequence):
+                sequence.finish_reason = "stop"
+            elif len(sequence.generated) >= sequence.max_new_tokens:
+                sequence.finish_reason = "length"
+            elif sequence.max_time and now - sequence.first_token_at >= sequence.max_time:
+                sequence.finish_reason = "time"
+            elif sequence.future.done():
+                sequence.finish_reason = "cancelled"
+            if sequence.finish_reason:
+                finished.append(sequence)
+                if sequence.streamer:
+                    sequence.streamer.end()
+            else:
+                keep.append(row)
+        if not keep:
+            self._reset()
+        elif finished:
+            index = torch.tensor(keep, device=self.device)
+            self.mask = self.mask.index_select(0, index)
+            start = int(self.mask.any(0).nonzero()[0])
+            self.mask = self.mask[:, start:]
+            self.cache = tuple(tuple(t.index_select(0, index)[:, :, start:] for t in layer) for layer in self.cache)
+            self.positions = self.positions.index_select(0, index)
+            self.next_tokens = self.next_tokens.index_select(0, index)
+            self.active = [self.active[row] for row in keep]
+        return finished
+
+    def _hit_stop_string(self, sequence: Sequence) -> bool:
+        if not sequence.stop:
+            return False
+        tail = self.tokenizer.decode(sequence.generated[-sequence.stop_window:], skip_special_tokens=True)
+        return any(text in tail for text in sequence.stop)
+
+    def decode(self, sequence: Sequence) -> str:
+        text, _ = cut_at_stop(self.tokenizer.decode(sequence.generated, skip_special_tokens=True), sequence.stop)
+        return text
+
+def legacy_cache(past_key_values) -> Tuple:
+    """The model's KV cache as per-layer (key, value) tuples, the only layout the engine pads and slices"""
+    if isinstance(past_key_values, Cache):
+        past_key_values = past_key_values.to_legacy_cache()
+    if not (isinstance(past_key_values, tuple) and past_key_values
+            and all(isinstance(layer, tuple) and len(layer) == 2 for layer in past_key_values)):
+        raise TypeError(f"Batching needs a per-layer (key, value) KV cache; the model returned "
+                        f"{type(past_key_values).__name__}")
+    return past_key_values
+
+def model_cache(model, cache: Tuple):
+    """Legacy tuples back in the cache class the model expects, for models that take Cache objects"""
+    return DynamicCache.from_legacy_cache(cache) if getattr(model, "_supports_cache_class", False) else cache
+
+def stop_token_ids(model, tokenizer) -> set:
+    """Token ids that end a turn: the generation config's EOS ids, the tokenizer's EOS and Llama 3 EOT markers"""
+    eos = model.generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, list) else [eos]) | {tokenizer.eos_token_id}
+    for token in STOP_TOKENS:
+        token_id = tokenizer.convert_tokens_to_ids(token)
+        if token_id is not None and token_id != tokenizer.unk_token_id:
+            ids.add(token_id)
+    ids.discard(None)
+    return ids
+
+def cut_at_stop(text: str, stop: List[str]) -> Tuple[str, bool]:
+    """Text before the earliest stop string, and whether one was found"""
+    cuts = [index for index in (text.find(s) for s in stop) if index != -1]
+    return (text[:min(cuts)], True) if cuts else (text, False)
+
+def stop_list(stop: Optional[Union[str, List[str]]]) -> List[str]:
+    return [stop] if isinstance(stop, str) else list(stop or [])
+
+def admit_sequence(sequence: Sequence, endpoint: str) -> None:
+    try:
+        engine.submit(sequence)
+    except QueueFullError as e:
+        REQUESTS.labels(endpoint, "503").inc()
+        raise HTTPException(status_code=503, detail=f"Generation queue full: {str(e)}",
+                            headers={"Retry-After": str(generation_retry_after)})
+
+async def run_sequence(sequence: Sequence, http_request: Request, endpoint: str) -> Sequence:
+    """Submit a sequence and wait for it, cancelling it on client disconnect or deadline"""
+    admit_sequence(sequence, endpoint)
+    deadline = time.monotonic() + generation_timeout
+    while True:
+        done, _ = await asyncio.wait({sequence.future}, timeout=disconnect_poll_interval)
+        if done:
+            return sequence.future.result()
+        # Cancelling the future makes the engine drop the sequence before its next step
+        if await http_request.is_disconnected():
+            sequence.future.cancel()
+            REQUESTS.labels(endpoint, "499").inc()
+            raise HTTPException(status_code=499, detail="Client disconnected")
+        if time.monotonic() > deadline:
+            sequence.future.cancel()
+            REQUESTS.labels(endpoint, "504").inc()
+            raise HTTPException(status_code=504, detail=f"Generation exceeded {generation_timeout:.0f}s")
+
+def sse_chunk(completion_id: str, created: int, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": "foundation-sec-8b",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+async def stream_chat(sequence: Sequence, started: float):
+    """OpenAI-style SSE deltas as the streamer releases text; the sequence is cancelled if the client leaves"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+    deadline = time.monotonic() + generation_timeout
+    # Text that could still turn out to be the start of a stop string is held back
+    holdback = max((len(text) for text in sequence.stop), default=1) - 1
+    received, sent, stopped = "", 0, False
+    IN_FLIGHT.inc()
+    try:
+        yield sse_chunk(completion_id, created, {"role": "assistant", "content": ""})
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                REQUESTS.labels("chat", "504").inc()
+                yield f"data: {json.dumps({'error': {'message': f'Generation exceeded {generation_timeout:.0f}s'}})}\n\n"
+                return
+            try:
+                text = await asyncio.wait_for(sequence.streamer.queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                continue
+            if text is None:
+                break
+            if stopped:
+                continue
+            received += text if received else text.lstrip()
+            received, stopped = cut_at_stop(received, sequence.stop)
+            ready = len(received) if stopped else len(received) - holdback
+            if ready > sent:
+                yield sse_chunk(completion_id, created, {"content": received[sent:ready]})
+                sent = ready
+        if sequence.finish_reason is None:
+            # Ended without finishing: the engine failed or the sequence was cancelled
+            REQUESTS.labels("chat", "500").inc()
+            yield f"data: {json.dumps({'error': {'message': 'Generation failed'}})}\n\n"
+            return
+        if len(received) > sent:
+            yield sse_chunk(completion_id, created, {"content": received[sent:]})
+        record_generation("chat", sequence, started)
+        yield sse_chunk(completion_id, created, {}, sequence.finish_reason)
+        yield "data: [DONE]\n\n"
+    finally:
+        IN_FLIGHT.dec()
+        if not sequence.future.done():
+            sequence.future.cancel()
+
+def cpu_supports_bf16() -> bool:
+    """Native bf16 matmul (AVX512-BF16 or AMX); elsewhere bf16 is emulated and slow"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def resolve_precision(device: str) -> str:
+    if device == "cuda":
+        if model_precision not in ("auto", "fp16"):
+            logger.warning(f"MODEL_PRECISION={model_precision} is CPU-only; loading fp16 on CUDA")
+        return "fp16"
+    if model_precision == "auto":
+        logger.warning("MODEL_PRECISION=auto: serving int8 dynamic-quantized weights on CPU "
+                       "(see GET /calibration; set MODEL_PRECISION=bf16 to serve unquantized weights)")
+        return "int8"
+    if model_precision not in ("fp32", "fp16", "bf16", "int8"):
+        raise ValueError(f"Unknown MODEL_PRECISION {model_precision!r}")
+    if model_precision == "bf16" and not cpu_supports_bf16():
+        logger.warning("CPU has no native bf16 support; bf16 will run emulated (int8 is usually faster)")
+    return model_precision
+
+def quantize_model(model):
+    """Replace linear layers with int8 dynamic versions (fbgemm kernels), one module at a time"""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                child.qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+                setattr(parent, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child.float()))
+            elif isinstance(child, torch.nn.Embedding):
+                child.qconfig = torch.ao.quantization.float_qparams_weight_only_qconfig
+                setattr(parent, name, torch.ao.nn.quantized.Embedding.from_float(child.float()))
+    # Remaining weights (norms, rotary tables) follow the fp32 activations
+    for module in model.modules():
+        for name, param in list(module.named_parameters(recurse=False)):
+            param.data = param.data.float()
+    model.config.torch_dtype = torch.float32
+    return model
+
+def quantized_state(model) -> Dict[str, Any]:
+    """Tensors-only snapshot of an int8 model, loadable with torch.load(weights_only=True)"""
+    buffers = {}
+    for module_name, module in model.named_modules():
+        for name in module._non_persistent_buffers_set:
+            if module._buffers.get(name) is not None:
+                buffers[f"{module_name}.{name}" if module_name else name] = module._buffers[name]
+    return {"state_dict": model.state_dict(), "buffers": buffers}
+
+def load_quantized_state(state: Dict[str, Any]):
+    """Rebuild an int8 model from quantized_state(): empty int8 modules on a meta skeleton, filled
+    by load_state_dict, so the bf16 weights are never materialized"""
+    from accelerate import init_empty_weights
+    config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32, trust_remote_code=True)
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                setattr(parent, name, torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features, child.out_features, bias_=child.bias is not None))
+            elif isinstance(child, torch.nn.Embedding):
+                setattr(parent, name, torch.ao.nn.quantized.Embedding(child.num_embeddings, child.embedding_dim))
+    model.to_empty(device="cpu")
+    model.load_state_dict(state["state_dict"])
+    for name, tensor in state["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        setattr(model.get_submodule(module_name), buffer_name, tensor)
+    model.config.torch_dtype = torch.float32
+    return model
+
+def model_bytes(model) -> int:
+    total = sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._weight_bias()
+            total += weight.numel() * weight.element_size() + (bias.numel() * bias.element_size() if bias is not None else 0)
+        elif isinstance(module, torch.ao.nn.quantized.Embedding):
+            total += module.weight().numel() * module.weight().element_size()
+    return total
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+CALIBRATION_PROMPT = (
+    "<|start_header_id|>user<|end_header_id|>\n\nWazuh alert (rule 5712, level 10): sshd brute force "
+    "trying to get access to the system from 203.0.113.7. Assess the threat and recommend actions.<|eot_id|>"
+    "<|start_header_id|>assistant<|end_header_id|>\n\n"
+)
+
+@torch.inference_mode()
+def measure(model, tokenizer, precision: str) -> Dict[str, Any]:
+    """Greedy single-sequence decode speed and weight memory for the calibration report"""
+    input_ids = tokenizer(CALIBRATION_PROMPT, return_tensors="pt").input_ids.to(model.device)
+    settings = {"do_sample": False, "pad_token_id": tokenizer.eos_token_id}
+    model.generate(input_ids, max_new_tokens=2, **settings)  # warm-up
+    started = time.perf_counter()
+    output = model.generate(input_ids, max_new_tokens=calibration_tokens, min_new_tokens=calibration_tokens,
+                            **settings)
+    elapsed = time.perf_counter() - started
+    tokens = output[0, input_ids.shape[1]:].tolist()
+    return {
+        "precision": precision,
+        "tokens_per_second": round(len(tokens) / elapsed, 3),
+        "model_bytes": model_bytes(model),
+        "resident_bytes": resident_bytes(),
+        "tokens": tokens
+    }
+
+def cache_paths(precision: str) -> Tuple[str, str]:
+    stem = os.path.join(quantized_cache_dir, f"{model_name.replace('/', '--')}-{precision}")
+    return f"{stem}.pt", f"{stem}.json"
+
+def load_quantized(precision: str):
+    """Quantized model from the disk cache, converting (and calibrating) on the first run"""
+    global calibration_report
+    model_path, report_path = cache_paths(precision)
+    if os.path.exists(model_path) and os.path.exists(report_path):
+        with open(report_path) as f:
+            report = json.load(f)
+        if report.get("torch") == torch.__version__:
+            logger.info(f"Loading cached {precision} model from {model_path}")
+            try:
+                # Tensors only: weights_only refuses any pickled code in the cache volume
+                model = load_quantized_state(torch.load(model_path, map_location="cpu", weights_only=True, mmap=True))
+                calibration_report = report
+                return model
+            except Exception as e:
+                logger.warning(f"Cached {precision} model at {model_path} is unusable ({e}); converting again")
+        else:
+            logger.info(f"Cached {precision} model was built with torch {report.get('torch')}; converting again")
+
+    logger.info(f"Converting model to {precision} (one-time; needs memory for the bf16 weights)...")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.bfloat16,
+        trust_remote_code=True,
+        low_cpu_mem_usage=True,
+        device_map="cpu"
+    ).eval()
+    baseline = measure(model, tokenizer, "bf16") if calibrate_on_convert else None
+    model = quantize_model(model).eval()
+    quantized = measure(model, tokenizer, precision) if calibrate_on_convert else None
+    report: Dict[str, Any] = {
+        "model": model_name,
+        "precision": precision,
+        "torch": torch.__version__,
+        "created": int(time.time()),
+        "model_bytes": model_bytes(model),
+        "memory_budget_bytes": memory_budget_bytes,
+        "fits_memory_budget": model_bytes(model) <= memory_budget_bytes
+    }
+    if baseline and quantized:
+        matching = sum(a == b for a, b in zip(baseline.pop("tokens"), quantized.pop("tokens")))
+        report.update({
+            "baseline": baseline,
+            "quantized": quantized,
+            "speedup": round(quantized["tokens_per_second"] / baseline["tokens_per_second"], 3),
+            "memory_ratio": round(quantized["model_bytes"] / baseline["model_bytes"], 3),
+            # Share of greedy tokens identical to the bf16 model's: a cheap quality signal
+            "greedy_agreement": round(matching / calibration_tokens, 3)
+        })
+    os.makedirs(quantized_cache_dir, exist_ok=True)
+    torch.save(quantized_state(model), model_path)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Calibration: {json.dumps({k: v for k, v in report.items() if k not in ('baseline', 'quantized')})}")
+    calibration_report = report
+    return model
+
 async def load_model():
-    global model, tokenizer, text_generator
+    global model, tokenizer, engine
     
     try:
-        model_name = "fdtn-ai/Foundation-Sec-8B-Instruct"
-        
         # Check if CUDA is available
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"Using device: {device}")
+        precision = resolve_precision(device)
+        logger.info(f"Using device: {device} ({precision})")
         
         # Load tokenizer with retry logic and force download
         logger.info("Loading tokenizer...")
@@ -91,30 +703,25 @@ async def load_model():
                 trust_remote_code=True,
                 low_cpu_mem_usage=True
             )
+        elif precision == "int8":
+            model = load_quantized(precision)
         else:
             # Use more aggressive memory optimization for CPU
             model = AutoModelForCausalLM.from_pretrained(
                 model_name,
-                torch_dtype=torch.float16,  # Use float16 even on CPU to save memory
+                torch_dtype={"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[precision],
                 trust_remote_code=True,
                 low_cpu_mem_usage=True,
                 device_map="cpu",
                 max_memory={"cpu": "8GB"}  # Limit CPU memory usage
             )
         
-        # Create text generation pipeline with memory optimization
-        text_generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            device=0 if device == "cuda" else -1,
-            torch_dtype=torch.float16,  # Use float16 for both CUDA and CPU
-            max_length=512,  # Limit max generation length
-            batch_size=1,    # Process one request at a time
-            return_full_text=False
-        )
+        model.eval()
+        MODEL_BYTES.set(model_bytes(model))
+        engine = BatchEngine(model, tokenizer, batch_max_size, batch_max_wait)
         
-        logger.info("Model and pipeline created successfully!")
+        MODEL_LOADED.set(1)
+        logger.info(f"Model and batching engine created successfully (max batch {batch_max_size})!")
         
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
@@ -125,7 +732,34 @@ async def health_check():
     """Health check endpoint"""
     if model is None or tokenizer is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
-    return {"status": "healthy", "model": "foundation-sec-8b"}
+    return {"status": "healthy", "model": "foundation-sec-8b", **engine.stats()}
+
+def record_generation(endpoint: str, sequence: Sequence, started: float) -> None:
+    """Metrics for a finished sequence, from the token counts the engine already has"""
+    now = time.monotonic()
+    REQUESTS.labels(endpoint, "200").inc()
+    REQUEST_LATENCY.labels(endpoint).observe(now - started)
+    TOKENS.labels("prompt").inc(len(sequence.prompt_ids))
+    TOKENS.labels("completion").inc(len(sequence.generated))
+    if sequence.first_token_at is None:
+        return
+    TIME_TO_FIRST_TOKEN.labels(endpoint).observe(sequence.first_token_at - started)
+    # Decode speed only: queue wait and prefill are already in the time to first token
+    decoding = now - sequence.first_token_at
+    if len(sequence.generated) > 1 and decoding > 0:
+        TOKENS_PER_SECOND.observe((len(sequence.generated) - 1) / decoding)
+
+@app.get("/calibration")
+async def calibration():
+    """Speed and memory of the quantized model against the bf16 baseline, from its conversion run"""
+    if calibration_report is None:
+        raise HTTPException(status_code=404, detail="No calibration report (MODEL_PRECISION is not int8)")
+    return calibration_report
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/")
 async def root():
@@ -137,41 +771,55 @@ async def root():
     }
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, http_request: Request):
     """OpenAI-compatible chat completions endpoint"""
-    if text_generator is None:
+    if engine is None:
+        REQUESTS.labels("chat", "503").inc()
         raise HTTPException(status_code=503, detail="Model not loaded")
     
+    started = time.monotonic()
+    # Convert messages to prompt format
+    prompt = ""
+    for message in request.messages:
+        if message.role == "system":
+            prompt += f"<|start_header_id|>system<|end_header_id|>\n\n{message.content}<|eot_id|>"
+        elif message.role == "user":
+            prompt += f"<|start_header_id|>user<|end_header_id|>\n\n{message.content}<|eot_id|>"
+        elif message.role == "assistant":
+            prompt += f"<|start_header_id|>assistant<|end_header_id|>\n\n{message.content}<|eot_id|>"
+    
+    prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
+    
+    if request.stream:
+        sequence = Sequence(
+            tokenizer(prompt).input_ids,
+            max_new_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            streamer=AsyncTextStreamer(tokenizer),
+            stop=stop_list(request.stop),
+            max_time=request.max_time
+        )
+        admit_sequence(sequence, "chat")
+        return StreamingResponse(stream_chat(sequence, started), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    
+    IN_FLIGHT.inc()
     try:
-        # Convert messages to prompt format
-        prompt = ""
-        for message in request.messages:
-            if message.role == "system":
-                prompt += f"<|start_header_id|>system<|end_header_id|>\n\n{message.content}<|eot_id|>"
-            elif message.role == "user":
-                prompt += f"<|start_header_id|>user<|end_header_id|>\n\n{message.content}<|eot_id|>"
-            elif message.role == "assistant":
-                prompt += f"<|start_header_id|>assistant<|end_header_id|>\n\n{message.content}<|eot_id|>"
-        
-        prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
-        
         # Generate response
-        outputs = text_generator(
-            prompt,
+        sequence = await run_sequence(Sequence(
+            tokenizer(prompt).input_ids,
             max_new_tokens=request.max_tokens,
             temperature=request.temperature,
             top_p=request.top_p,
-            do_sample=True,
-            pad_token_id=tokenizer.eos_token_id,
-            return_full_text=False
-        )
+            stop=stop_list(request.stop),
+            max_time=request.max_time
+        ), http_request, "chat")
         
-        generated_text = outputs[0]['generated_text'].strip()
-        
-        # Remove any trailing tokens
-        if "<|eot_id|>" in generated_text:
-            generated_text = generated_text.split("<|eot_id|>")[0].strip()
+        # Decoding stopped at the end-of-turn token, so there is nothing left to trim
+        generated_text = engine.decode(sequence).strip()
         
+        record_generation("chat", sequence, started)
         response = ChatResponse(
             choices=[
                 {
@@ -180,45 +828,61 @@ async def chat_completions(request: ChatRequest):
                         "role": "assistant",
                         "content": generated_text
                     },
-                    "finish_reason": "stop"
+                    "finish_reason": sequence.finish_reason
                 }
             ]
         )
         
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}")
+        REQUESTS.labels("chat", "500").inc()
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    finally:
+        IN_FLIGHT.dec()
 
 @app.post("/generate")
-async def generate_text(request: Dict):
+async def generate_text(request: Dict, http_request: Request):
     """Simple text generation endpoint"""
-    if text_generator is None:
+    if engine is None:
+        REQUESTS.labels("generate", "503").inc()
         raise HTTPException(status_code=503, detail="Model not loaded")
     
+    started = time.monotonic()
+    IN_FLIGHT.inc()
     try:
         prompt = request.get("prompt", "")
-        max_tokens = request.get("max_tokens", 512)
+        max_tokens = request.get("max_tokens")
         temperature = request.get("temperature", 0.7)
         
-        outputs = text_generator(
-            prompt,
+        sequence = await run_sequence(Sequence(
+            tokenizer(prompt).input_ids,
             max_new_tokens=max_tokens,
             temperature=temperature,
-            do_sample=True,
-            pad_token_id=tokenizer.eos_token_id,
-            return_full_text=False
-        )
+            top_p=1.0,
+            stop=stop_list(request.get("stop")),
+            max_time=request.get("max_time")
+        ), http_request, "generate")
+        generated_text = engine.decode(sequence)
         
+        record_generation("generate", sequence, started)
         return {
-            "generated_text": outputs[0]['generated_text'],
+            "generated_text": generated_text,
+            "finish_reason": sequence.finish_reason,
             "model": "foundation-sec-8b"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating text: {str(e)}")
+        REQUESTS.labels("generate", "500").inc()
         raise HTTPException(status_code=500, detail=f"Error generating text: {str(e)}")
+    finally:
+        IN_FLIGHT.dec()
 
 if __name__ == "__main__":
     uvicorn.run(
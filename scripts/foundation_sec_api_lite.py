@@ -5,19 +5,31 @@ This avoids loading the heavy model directly and prevents VM freezing
 """
 
 import asyncio
+import hashlib
 import logging
 import os
-import requests
 import json
+import random
+import re
+import sqlite3
+import threading
 import time
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from itertools import islice
+import httpx
+import numpy as np
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+from pydantic import BaseModel, PrivateAttr
+from typing import Awaitable, Callable, List, Optional, Dict, Any, Set, Tuple, Union
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Pydantic models for API requests/responses
 class ChatMessage(BaseModel):
@@ -30,6 +42,24 @@ class ChatRequest(BaseModel):
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
     stream: Optional[bool] = False
+    priority: Optional[str] = None  # critical/high, standard, interactive (or X-Priority header)
+    # OpenAI-style: {"type": "json_object"} or {"type": "json_schema", "json_schema": {"schema": {...}}}
+    response_format: Optional[Dict[str, Any]] = None
+    severity: Optional[int] = None  # Wazuh rule level, when the request is about one alert (or a pack)
+    user: Optional[str] = None  # caller identity for routing (or X-Caller header)
+    _route: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+    _alerts: List[Dict[str, Any]] = PrivateAttr(default_factory=list)  # set by the alert endpoints
+
+class AlertAnalysisRequest(BaseModel):
+    alerts: List[Dict[str, Any]]
+    model: str = "foundation-sec"
+    priority: Optional[str] = None
+
+class VerdictRequest(BaseModel):
+    alert: Optional[Dict[str, Any]] = None  # normalized or raw Wazuh alert, rendered from a compact template
+    prompt: Optional[str] = None  # free-form text, used only when no alert is given
+    model: str = "foundation-sec"
+    priority: Optional[str] = None
 
 class ChatResponse(BaseModel):
     id: str
@@ -38,9 +68,13 @@ class ChatResponse(BaseModel):
     model: str
     choices: List[Dict[str, Any]]
     usage: Dict[str, int]
+    timings: Optional[Dict[str, float]] = None
+    provider: Optional[str] = None  # backend that actually served the completion
 
 # Global variables / provider config
 ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
+# Comma-separated list of Ollama replicas; defaults to the single OLLAMA_URL
+ollama_urls = [url.strip().rstrip("/") for url in os.getenv("OLLAMA_URLS", ollama_url).split(",") if url.strip()]
 ai_provider = os.getenv("AI_PROVIDER", "ollama").lower()  # "ollama" or "deepseek"
 # DeepSeek settings (OpenAI-compatible)
 deepseek_base = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").rstrip("/")
@@ -48,37 +82,1961 @@ deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
 deepseek_default_model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 model_name = "foundation-sec"
 
+# Upstream HTTP client settings (shared keep-alive pool for Ollama and DeepSeek)
+upstream_pool_size = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+upstream_keepalive = int(os.getenv("UPSTREAM_KEEPALIVE", str(upstream_pool_size)))
+upstream_connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+ollama_timeout = float(os.getenv("OLLAMA_TIMEOUT", "60"))
+deepseek_timeout = float(os.getenv("DEEPSEEK_TIMEOUT", "60"))
+probe_timeout = float(os.getenv("PROBE_TIMEOUT", "5"))
+http_client: Optional[httpx.AsyncClient] = None
+
+# Response cache settings (exact match on normalized request)
+cache_enabled = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+cache_max_bytes = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+cache_max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+cache_ttl = float(os.getenv("CACHE_TTL", "3600"))
+# By default only deterministic (temperature 0) requests are cached
+cache_all_temperatures = os.getenv("CACHE_ALL_TEMPERATURES", "false").lower() == "true"
+
+# Verdict store: completed analyses in SQLite (WAL) so they survive restarts and are shared
+# between gateway processes that point at the same file
+verdict_store_enabled = os.getenv("VERDICT_STORE_ENABLED", "true").lower() == "true"
+verdict_store_path = os.getenv("VERDICT_STORE_PATH", "verdict-store/verdicts.db")
+verdict_store_max_bytes = int(os.getenv("VERDICT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+verdict_store_ttl = float(os.getenv("VERDICT_STORE_TTL", str(7 * 24 * 3600)))
+verdict_store_warm_entries = int(os.getenv("VERDICT_STORE_WARM_ENTRIES", "1000"))
+
+# Semantic cache: near-duplicate prompts reuse a prior verdict (Ollama embeddings + NumPy index)
+semantic_cache_enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+semantic_cache_model = os.getenv("SEMANTIC_CACHE_MODEL", "nomic-embed-text")
+semantic_cache_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+semantic_cache_dir = os.getenv("SEMANTIC_CACHE_DIR", "semantic-cache")
+semantic_cache_max_entries = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "20000"))
+semantic_cache_ttl = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+semantic_cache_ivf_min = int(os.getenv("SEMANTIC_CACHE_IVF_MIN", "4096"))  # flat search below this size
+semantic_cache_nprobe = int(os.getenv("SEMANTIC_CACHE_NPROBE", "8"))
+semantic_cache_timeout = float(os.getenv("SEMANTIC_CACHE_TIMEOUT", "5"))
+
+# Merge identical concurrent (non-streaming) completions into one upstream call
+singleflight_enabled = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+
+# Priority scheduler: bounded upstream concurrency per backend, weighted lanes
+ollama_concurrency = int(os.getenv("OLLAMA_CONCURRENCY", "1"))  # per Ollama replica
+deepseek_concurrency = int(os.getenv("DEEPSEEK_CONCURRENCY", "4"))
+scheduler_default_lane = os.getenv("SCHEDULER_DEFAULT_LANE", "standard").lower()
+scheduler_weights = {
+    lane: int(weight)
+    for lane, weight in (item.split("=") for item in os.getenv(
+        "SCHEDULER_WEIGHTS", "critical=6,standard=3,interactive=1").split(","))
+}
+
+# Admission control: bounded lane queues; rejected requests get 429 + Retry-After from measured throughput
+admission_queue_limits = {
+    lane: int(limit)
+    for lane, limit in (item.split("=") for item in os.getenv(
+        "ADMISSION_QUEUE_LIMITS", "critical=128,standard=64,interactive=16").split(","))
+}
+admission_max_wait = float(os.getenv("ADMISSION_MAX_WAIT", "60"))  # shed when the estimated wait is longer; 0 disables
+admission_retry_after = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # until throughput has been measured
+admission_max_retry_after = float(os.getenv("ADMISSION_MAX_RETRY_AFTER", "120"))
+admission_window = float(os.getenv("ADMISSION_THROUGHPUT_WINDOW", "60"))
+# Degraded mode: low-severity alerts get a rule-level verdict instead of queuing for the model
+degraded_mode = os.getenv("DEGRADED_MODE", "false").lower() == "true"
+degrade_below_level = int(os.getenv("DEGRADE_BELOW_LEVEL", "7"))
+degrade_queue_depth = int(os.getenv("DEGRADE_QUEUE_DEPTH", "4"))
+
+# Replica load balancing: passive ejection after consecutive failures, re-admitted after a backoff
+ollama_eject_after = int(os.getenv("OLLAMA_EJECT_AFTER", "3"))
+ollama_eject_seconds = float(os.getenv("OLLAMA_EJECT_SECONDS", "30"))
+ollama_affinity_weight = float(os.getenv("OLLAMA_AFFINITY_WEIGHT", "2"))
+ollama_max_attempts = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "2"))
+
+# Circuit breakers (per provider) and latency-bounded failover to a second provider
+breaker_window = int(os.getenv("BREAKER_WINDOW", "20"))
+breaker_min_calls = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+breaker_error_rate = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+breaker_slow_rate = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+breaker_slow_seconds = float(os.getenv("BREAKER_SLOW_SECONDS", "30"))
+breaker_open_seconds = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+failover_provider = os.getenv("FAILOVER_PROVIDER", "").lower()  # e.g. "deepseek"; empty disables failover
+hedge_after_seconds = float(os.getenv("HEDGE_AFTER_SECONDS", "0"))  # 0 disables hedging
+
+# Standard-alert ingest buffer: in-memory ring backed by an append-only segment log
+alert_buffer_capacity = int(os.getenv("ALERT_BUFFER_CAPACITY", "50000"))
+alert_log_dir = os.getenv("ALERT_LOG_DIR", "alert-buffer")
+alert_segment_bytes = int(os.getenv("ALERT_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+alert_fsync_interval = float(os.getenv("ALERT_FSYNC_INTERVAL", "1"))
+alert_max_batch = int(os.getenv("ALERT_MAX_BATCH", "5000"))
+alert_retry_after = int(os.getenv("ALERT_RETRY_AFTER", "5"))
+alert_lease_seconds = float(os.getenv("ALERT_LEASE_SECONDS", "300"))  # drained alerts return unless acked in time
+
+# Alert deduplication: one forwarded alert per fingerprint per sliding window, then an aggregate
+alert_fingerprint_fields = [f.strip() for f in os.getenv("ALERT_FINGERPRINT", "rule_id,agent_id,agent_ip,srcip").split(",") if f.strip()]
+alert_dedup_window = float(os.getenv("ALERT_DEDUP_WINDOW", "60"))
+alert_dedup_max_window = float(os.getenv("ALERT_DEDUP_MAX_WINDOW", "600"))
+alert_dedup_max_groups = int(os.getenv("ALERT_DEDUP_MAX_GROUPS", "10000"))
+alert_dedup_samples = int(os.getenv("ALERT_DEDUP_SAMPLES", "3"))
+# Aggregates of high-priority alerts go back to the high-priority workflow; empty keeps them in the buffer
+alert_high_priority_url = os.getenv("ALERT_HIGH_PRIORITY_URL", "http://n8n:5678/webhook/high-priority-alert")
+alert_high_priority_level = int(os.getenv("ALERT_HIGH_PRIORITY_LEVEL", "7"))  # as the webhook receiver
+
+# Structured verdicts (schema-constrained output)
+verdict_max_tokens = int(os.getenv("VERDICT_MAX_TOKENS", "96"))
+
+# Batch alert analysis: several alerts per LLM call, packed up to a token budget
+batch_prompt_tokens = int(os.getenv("BATCH_PROMPT_TOKENS", "1536"))
+batch_max_alerts = int(os.getenv("BATCH_MAX_ALERTS", "8"))
+batch_tokens_per_verdict = int(os.getenv("BATCH_TOKENS_PER_VERDICT", "48"))
+batch_log_tokens = int(os.getenv("BATCH_LOG_TOKENS", "100"))  # full_log budget per packed alert
+
+# Backend state is refreshed in the background; /health, /ready and /models read the snapshot
+health_refresh_interval = float(os.getenv("HEALTH_REFRESH_INTERVAL", "15"))
+health_stale_after = float(os.getenv("HEALTH_STALE_AFTER", str(health_refresh_interval * 3)))
+ready_model = os.getenv("READY_MODEL", "tinyllama:latest")
+
+# Token accounting and context sizing for Ollama
+tokenizer_name = os.getenv("TOKENIZER_NAME", "")  # optional HF tokenizer for local counts
+ollama_max_predict = int(os.getenv("OLLAMA_MAX_PREDICT", "256"))
+ollama_min_ctx = int(os.getenv("OLLAMA_NUM_CTX", "2048"))
+ollama_max_ctx = int(os.getenv("OLLAMA_MAX_CTX", "8192"))
+ollama_ctx_step = int(os.getenv("OLLAMA_CTX_STEP", "2048"))
+tokenizer = None
+
+# Prompt compaction: oversized user messages are deduplicated, de-noised and cut to head + tail
+compaction_enabled = os.getenv("COMPACTION_ENABLED", "true").lower() == "true"
+compaction_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "1536"))  # per user message
+compaction_log_tokens = int(os.getenv("COMPACT_LOG_TOKENS", "512"))  # full_log budget in /v1/verdict
+compaction_head_ratio = float(os.getenv("COMPACT_HEAD_RATIO", "0.6"))
+map_reduce_enabled = os.getenv("COMPACT_MAP_REDUCE", "false").lower() == "true"
+map_reduce_min_tokens = int(os.getenv("COMPACT_MAP_REDUCE_MIN_TOKENS", "4096"))
+map_reduce_chunk_tokens = int(os.getenv("COMPACT_MAP_REDUCE_CHUNK_TOKENS", "1024"))
+map_reduce_max_chunks = int(os.getenv("COMPACT_MAP_REDUCE_MAX_CHUNKS", "8"))
+map_reduce_summary_tokens = int(os.getenv("COMPACT_MAP_REDUCE_SUMMARY_TOKENS", "96"))
+
+# Model routing policy (JSON rules; the built-in policy uses these two models)
+routing_policy_file = os.getenv("ROUTING_POLICY_FILE", "")
+routing_small_model = os.getenv("ROUTING_SMALL_MODEL", "tinyllama:latest")
+routing_large_model = os.getenv("ROUTING_LARGE_MODEL", "bogdancsn/foundation-sec-8b:latest")
+
+# Disable proxy buffering so SSE chunks reach the client as soon as they are produced
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Prometheus metrics. Hot-path metrics are plain counters/histograms updated from the event
+# loop thread; queue, cache and backend state are read from existing stats at scrape time.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120)
+TOKENS_PER_SECOND_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+REQUESTS = Counter("gateway_requests_total", "Chat completion requests",
+                   ["provider", "model", "source", "status"])
+REQUEST_LATENCY = Histogram("gateway_request_duration_seconds", "End-to-end chat completion latency",
+                            ["provider", "model", "source"], buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram("gateway_time_to_first_token_seconds", "Time until the first generated token",
+                                ["provider", "model"], buckets=LATENCY_BUCKETS)
+TOKENS_PER_SECOND = Histogram("gateway_completion_tokens_per_second", "Generation speed per request",
+                              ["provider", "model"], buckets=TOKENS_PER_SECOND_BUCKETS)
+TOKENS = Counter("gateway_tokens_total", "Prompt and completion tokens processed upstream",
+                 ["provider", "model", "kind"])
+UPSTREAM_ERRORS = Counter("gateway_upstream_errors_total", "Failed upstream calls by status",
+                          ["provider", "status"])
+IN_FLIGHT = Gauge("gateway_requests_in_flight", "Chat completion requests currently being served")
+ADMISSION_REJECTIONS = Counter("gateway_admission_rejections_total", "Requests shed by admission control",
+                               ["backend", "lane", "reason"])
+DEGRADED_VERDICTS = Counter("gateway_degraded_verdicts_total", "Alerts answered by the rule-level heuristic under load")
+ROUTE_DECISIONS = Counter("gateway_route_decisions_total", "Ollama routing decisions by policy rule",
+                          ["rule", "model"])
+
+def queue_full_response(error: "QueueFullError") -> HTTPException:
+    return HTTPException(status_code=429, detail=f"Overloaded: {error}; retry later",
+                         headers={"Retry-After": str(max(1, int(error.retry_after + 0.5)))})
+
+def upstream_timeout(total: float) -> httpx.Timeout:
+    """Per-call timeout: bounded connect time, `total` for read/write/pool wait"""
+    return httpx.Timeout(total, connect=min(upstream_connect_timeout, total))
+
+class ResponseCache:
+    """In-memory LRU cache with TTL expiry and a byte budget"""
+
+    def __init__(self, max_bytes: int, max_entries: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        size = len(key) + len(json.dumps(value, separators=(",", ":")))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes or len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.bytes_used -= size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes_used = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": cache_enabled,
+            "entries": len(self._entries),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+response_cache = ResponseCache(cache_max_bytes, cache_max_entries, cache_ttl)
+
+class VerdictStore:
+    """Disk tier behind the response cache: SQLite in WAL mode, evicting least recently used rows by size.
+
+    Calls are short and run in worker threads; one connection is shared behind a lock.
+    Other processes may open the same file concurrently (WAL readers do not block the writer).
+    """
+
+    TOUCH_INTERVAL = 60.0  # seconds between last-access updates for a hot row
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.entries = 0
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.warmed = 0
+
+    def open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                   "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS verdicts_accessed ON verdicts (accessed)")
+        self._db = db
+        self._evict()
+        logger.info(f"Verdict store: {self.entries} entries ({self.bytes_used} bytes) in {self.path}")
+
+    def warm(self, cache: ResponseCache, limit: int) -> int:
+        """Load the most recently used verdicts into the in-memory cache"""
+        with self._lock:
+            rows = self._db.execute("SELECT key, response FROM verdicts WHERE created >= ? "
+                                    "ORDER BY accessed DESC LIMIT ?", (time.time() - self.ttl, limit)).fetchall()
+        for key, response in reversed(rows):  # most recent last, so it is the newest LRU entry
+            cache.put(key, json.loads(response))
+        self.warmed = len(rows)
+        return self.warmed
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, created, accessed FROM verdicts WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now - self.ttl:
+                self.misses += 1
+                return None
+            if now - row[2] > self.TOUCH_INTERVAL:
+                self._db.execute("UPDATE verdicts SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        encoded = json.dumps(value, separators=(",", ":"))
+        size = len(key) + len(encoded)
+        now = time.time()
+        with self._lock:
+            # A rewritten key replaces its row: count only the size difference
+            old = self._db.execute("SELECT size FROM verdicts WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO verdicts (key, response, size, created, accessed) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, encoded, size, now, now))
+            self.writes += 1
+            if old is None:
+                self.entries += 1
+            self.bytes_used += size - (old[0] if old else 0)
+        if self.bytes_used > self.max_bytes or self.writes % 500 == 0:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Drop expired rows, then least recently used rows until under 90% of the byte budget"""
+        with self._lock:
+            deleted = self._db.execute("DELETE FROM verdicts WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            self.entries, self.bytes_used = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM verdicts").fetchone()
+            if self.bytes_used > self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                excess = self.bytes_used - target
+                cutoff = self._db.execute(
+                    "SELECT accessed FROM (SELECT accessed, SUM(size) OVER (ORDER BY accessed) AS running "
+                    "FROM verdicts) WHERE running >= ? LIMIT 1", (excess,)).fetchone()
+                if cutoff:
+                    deleted += self._db.execute("DELETE FROM verdicts WHERE accessed <= ?", cutoff).rowcount
+                self.entries, self.bytes_used = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM verdicts").fetchone()
+        self.evictions += deleted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM verdicts")
+            self.entries = 0
+            self.bytes_used = 0
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": verdict_store_enabled,
+            "path": self.path,
+            "entries": self.entries,
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "warmed": self.warmed
+        }
+
+verdict_store = VerdictStore(verdict_store_path, verdict_store_max_bytes, verdict_store_ttl)
+
+# High-entropy noise that costs tokens without helping triage: GUIDs, timestamps, hex ids, base64 blobs
+_NOISE_PATTERN = (
+    r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b"
+    r"|\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+    r"|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec) +\d{1,2} \d{2}:\d{2}:\d{2}\b"
+    r"|\b0x[0-9a-f]+\b|\b[0-9a-f]{12,}\b"
+    r"|\b[A-Za-z0-9+/]{40,}={0,2}"
+)
+_noise_tokens = re.compile(_NOISE_PATTERN, re.IGNORECASE)
+# Plus the values of fields that differ between otherwise identical alerts: PIDs (sshd[1234], pid=1234),
+# ports and request/session ids. Other numbers (rule IDs, levels, agent IDs, addresses) change the verdict.
+_volatile_fields = re.compile(
+    r"\b((?:pid|(?:src_?|dst_?)?port|(?:request|req|session|trace)[_-]?id)[\"']?\s*[=:]?\s*[\"']?)[\w-]+"
+    r"|(?<=\[)\d+(?=\])",
+    re.IGNORECASE)
+# Alert identity in free-text prompts ("Rule ID: 5712", "Severity Level: 10", "Agent ID: 001")
+_identity_fields = re.compile(r"\b(rule(?:[ _.]?id)?|level|agent(?:[ _.]?id)?)\b\W{0,3}(\d+)\b", re.IGNORECASE)
+
+def strip_volatile(text: str) -> str:
+    text = _volatile_fields.sub(lambda m: (m.group(1) or "") + "#", _noise_tokens.sub("#", text))
+    return " ".join(text.split())
+
+class SemanticCache:
+    """Near-duplicate response cache over prompt embeddings.
+
+    Unit vectors live in a memory-mapped float32 matrix (a ring of `capacity` rows) with the
+    responses in a JSONL sidecar, so restarts reload without re-embedding. Search is a flat
+    batched dot product until `semantic_cache_ivf_min` rows, then an IVF partition: k-means
+    centroids trained off the event loop, probing the `semantic_cache_nprobe` closest lists.
+    """
+
+    def __init__(self, directory: str, capacity: int):
+        self.directory = directory
+        self.capacity = capacity
+        self.dim = 0
+        self.vectors: Optional[np.memmap] = None
+        self.scopes = np.zeros(capacity, dtype=np.int64)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.responses: Dict[int, Dict[str, Any]] = {}
+        self.size = 0
+        self.next_row = 0
+        self._meta = None
+        # IVF state; `assign` lets stale list entries (overwritten rows) be filtered out
+        self.centroids: Optional[np.ndarray] = None
+        self.assign = np.full(capacity, -1, dtype=np.int32)
+        self.lists: List[List[int]] = []
+        self.writes_since_train = 0
+        self.trained_rows = 0
+        self._training: Optional[asyncio.Task] = None
+        self._written_while_training: List[int] = []
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._path("index.json")) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            info = {}
+        if info.get("model") != semantic_cache_model or info.get("capacity") != self.capacity:
+            if info:
+                logger.info("Semantic cache model or capacity changed; starting a new index")
+            self._reset_files()
+            return
+        try:
+            self._load(info)
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+            # Missing sidecar, truncated vectors or malformed records: as good as a corrupt index
+            logger.warning(f"Semantic cache in {self.directory} is incomplete or inconsistent ({e!r}); "
+                           f"starting a new index")
+            self.clear()
+            return
+        if self.size >= semantic_cache_ivf_min:
+            self.centroids, self.lists = self._train(self.size)
+            for cluster, members in enumerate(self.lists):
+                self.assign[members] = cluster
+            self.trained_rows = self.size
+        logger.info(f"Semantic cache: loaded {self.size} entries from {self.directory}")
+
+    def _load(self, info: Dict[str, Any]) -> None:
+        dim = info["dim"]
+        if isinstance(dim, bool) or not isinstance(dim, int) or dim <= 0:
+            raise ValueError(f"bad dimension {dim!r}")
+        expected = self.capacity * dim * np.dtype(np.float32).itemsize
+        if os.path.getsize(self._path("vectors.f32")) != expected:
+            raise ValueError(f"vectors.f32 is not {expected} bytes")
+        self._map(dim)
+        last_write: Dict[int, int] = {}
+        lines = 0
+        with open(self._path("entries.jsonl"), encoding="utf-8") as f:
+            for lines, line in enumerate(f, start=1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn final line after a crash
+                row = entry["row"]
+                if 0 <= row < self.capacity:
+                    self.responses[row] = entry["response"]
+                    self.scopes[row] = entry["scope"]
+                    self.created[row] = entry["created"]
+                    last_write[row] = lines
+        self.size = len(self.responses)
+        if last_write:
+            self.next_row = (max(last_write, key=last_write.get) + 1) % self.capacity
+        if lines > 2 * max(self.size, 1):
+            self._compact(sorted(last_write, key=last_write.get))
+        self._meta = open(self._path("entries.jsonl"), "a", encoding="utf-8")
+
+    def _reset_files(self) -> None:
+        for name in ("index.json", "vectors.f32", "entries.jsonl"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self._meta = open(self._path("entries.jsonl"), "a", encoding="utf-8")
+
+    def _map(self, dim: int) -> None:
+        path = self._path("vectors.f32")
+        mode = "r+" if os.path.exists(path) else "w+"
+        self.vectors = np.memmap(path, dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+        self.dim = dim
+
+    def _compact(self, rows_in_write_order: List[int]) -> None:
+        tmp = self._path("entries.jsonl.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for row in rows_in_write_order:
+                f.write(self._record(row) + "\n")
+        os.replace(tmp, self._path("entries.jsonl"))
+
+    def _record(self, row: int) -> str:
+        return json.dumps({"row": row, "scope": int(self.scopes[row]), "created": float(self.created[row]),
+                           "response": self.responses[row]}, separators=(",", ":"))
+
+    def close(self) -> None:
+        if self.vectors is not None:
+            self.vectors.flush()
+        if self._meta:
+            self._meta.close()
+            self._meta = None
+
+    def clear(self) -> None:
+        self.close()
+        self.vectors = None
+        self.dim = 0
+        self.responses.clear()
+        self.size = 0
+        self.next_row = 0
+        self.centroids = None
+        self.lists = []
+        self.assign.fill(-1)
+        self.trained_rows = 0
+        self.writes_since_train = 0
+        self._reset_files()
+
+    def search(self, queries: np.ndarray, scope: int) -> List[Tuple[int, float]]:
+        """Best (row, cosine) for each query row among live entries in `scope`; row is -1 if none"""
+        if self.size == 0 or self.vectors is None:
+            return [(-1, 0.0)] * len(queries)
+        live = (self.scopes[:self.size] == scope) & (self.created[:self.size] >= time.time() - semantic_cache_ttl)
+        if self.centroids is None:
+            scores = queries @ np.asarray(self.vectors[:self.size]).T
+            scores[:, ~live] = -1.0
+            best = np.argmax(scores, axis=1)
+            return [(int(row), float(scores[i, row])) for i, row in enumerate(best)]
+        results = []
+        nprobe = min(semantic_cache_nprobe, len(self.centroids))
+        for query in queries:
+            probe = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+            rows = np.unique(np.concatenate([np.asarray(self.lists[c], dtype=np.int64) for c in probe]))
+            rows = rows[(rows < self.size) & np.isin(self.assign[rows], probe)]
+            rows = rows[live[rows]]
+            if not len(rows):
+                results.append((-1, 0.0))
+                continue
+            scores = np.asarray(self.vectors[rows]) @ query
+            best = int(np.argmax(scores))
+            results.append((int(rows[best]), float(scores[best])))
+        return results
+
+    def add(self, vector: np.ndarray, scope: int, response: Dict[str, Any]) -> None:
+        if self.vectors is None:
+            self._map(len(vector))
+            with open(self._path("index.json"), "w") as f:
+                json.dump({"model": semantic_cache_model, "capacity": self.capacity, "dim": self.dim}, f)
+        if len(vector) != self.dim:
+            return
+        row = self.next_row
+        self.next_row = (row + 1) % self.capacity
+        self.vectors[row] = vector
+        self.scopes[row] = scope
+        self.created[row] = time.time()
+        self.responses[row] = response
+        self.size = max(self.size, row + 1)
+        self._meta.write(self._record(row) + "\n")
+        self._meta.flush()
+        self.writes_since_train += 1
+        if self.centroids is not None:
+            cluster = int(np.argmax(self.centroids @ vector))
+            self.assign[row] = cluster
+            self.lists[cluster].append(row)
+        if self._training is not None:
+            self._written_while_training.append(row)
+        elif self.size >= semantic_cache_ivf_min and self.writes_since_train >= max(self.trained_rows, semantic_cache_ivf_min):
+            self._training = asyncio.create_task(self._retrain())
+
+    async def _retrain(self) -> None:
+        """Rebuild the IVF partition in a worker thread once the index has doubled or turned over"""
+        rows = self.size
+        try:
+            self.vectors.flush()
+            centroids, lists = await asyncio.to_thread(self._train, rows)
+            assign = np.full(self.capacity, -1, dtype=np.int32)
+            for cluster, members in enumerate(lists):
+                assign[members] = cluster
+            for row in self._written_while_training:
+                cluster = int(np.argmax(centroids @ self.vectors[row]))
+                assign[row] = cluster
+                lists[cluster].append(row)
+            self.centroids, self.lists, self.assign = centroids, lists, assign
+            self.trained_rows = rows
+            self.writes_since_train = 0
+            logger.info(f"Semantic cache: trained {len(centroids)} IVF lists over {rows} entries")
+        except Exception as e:
+            logger.warning(f"Semantic cache IVF training failed: {str(e)}")
+        finally:
+            self._written_while_training = []
+            self._training = None
+
+    def _train(self, rows: int) -> Tuple[np.ndarray, List[List[int]]]:
+        """Spherical k-means with sqrt(rows) centroids; returns (centroids, member rows per list)"""
+        data = np.array(self.vectors[:rows])
+        k = max(1, int(np.sqrt(rows)))
+        rng = np.random.default_rng(0)
+        centroids = data[rng.choice(rows, k, replace=False)].copy()
+        for _ in range(8):
+            labels = self._nearest(data, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+        labels = self._nearest(data, centroids)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.cumsum(np.bincount(labels, minlength=k))[:-1]
+        return centroids, [part.tolist() for part in np.split(order, bounds)]
+
+    @staticmethod
+    def _nearest(data: np.ndarray, centroids: np.ndarray, chunk: int = 16384) -> np.ndarray:
+        return np.concatenate([np.argmax(data[i:i + chunk] @ centroids.T, axis=1)
+                               for i in range(0, len(data), chunk)])
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        replica = ollama_pool.acquire(semantic_cache_model)
+        ok: Optional[bool] = None
+        try:
+            response = await http_client.post(
+                f"{replica.url}/api/embeddings",
+                json={"model": semantic_cache_model, "prompt": text},
+                timeout=upstream_timeout(semantic_cache_timeout),
+            )
+            response.raise_for_status()
+            vector = np.asarray(response.json()["embedding"], dtype=np.float32)
+            ok = True
+        except httpx.RequestError as e:
+            ok = False
+            self.errors += 1
+            logger.warning(f"Embedding request failed: {str(e) or type(e).__name__}")
+            return None
+        except (httpx.HTTPStatusError, KeyError, ValueError) as e:
+            self.errors += 1
+            logger.warning(f"Embedding with {semantic_cache_model} failed: {str(e)}")
+            return None
+        finally:
+            ollama_pool.release(replica, ok, semantic_cache_model if ok else None)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else None
+
+    async def lookup(self, request: "ChatRequest", provider: str, model: str) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[np.ndarray, int]]]:
+        """(cached response or None, probe to store the fresh response under)"""
+        text = strip_volatile("\n".join(m.content for m in request.messages if m.role != "system"))
+        vector = await self.embed(text)
+        if vector is None:
+            return None, None
+        scope = semantic_scope(request, provider, model)
+        row, score = self.search(vector[None, :], scope)[0]
+        if row >= 0 and score >= semantic_cache_threshold:
+            self.hits += 1
+            return self.responses[row], (vector, scope)
+        self.misses += 1
+        return None, (vector, scope)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": semantic_cache_enabled,
+            "model": semantic_cache_model,
+            "threshold": semantic_cache_threshold,
+            "entries": self.size,
+            "capacity": self.capacity,
+            "dim": self.dim,
+            "index": "ivf" if self.centroids is not None else "flat",
+            "ivf_lists": len(self.lists),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "embedding_errors": self.errors
+        }
+
+def alert_identity(request: "ChatRequest") -> List[List[str]]:
+    """Rule ID, rule level and agent ID of the alerts a request is about"""
+    if request._alerts:
+        return [[str(alert_field(alert, "rule_id", ("rule", "id"))),
+                 str(alert_field(alert, "rule_level", ("rule", "level"))),
+                 str(alert_field(alert, "agent_id", ("agent", "id")))] for alert in request._alerts]
+    text = "\n".join(m.content for m in request.messages if m.role != "system")
+    return [[re.sub(r"[^a-z]", "", name.lower()), value] for name, value in _identity_fields.findall(text)]
+
+def semantic_scope(request: "ChatRequest", provider: str, model: str) -> int:
+    """Only prompts with the same model, system prompt, parameters and alert identity may share a verdict"""
+    scope = json.dumps([provider, model, (request.model or "").strip().lower(),
+                        [m.content for m in request.messages if m.role == "system"],
+                        request.temperature, request.max_tokens, request.response_format,
+                        alert_identity(request)], sort_keys=True)
+    return int.from_bytes(hashlib.sha256(scope.encode("utf-8")).digest()[:8], "big", signed=True)
+
+semantic_cache = SemanticCache(semantic_cache_dir, semantic_cache_max_entries)
+
+class SingleFlight:
+    """Coalesce identical in-flight calls so one upstream result fans out to every waiter"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self.seconds_saved = 0.0
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True when another caller's call was reused"""
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            self._waiters[key] += 1
+            self.max_waiters = max(self.max_waiters, self._waiters[key])
+            return await asyncio.shield(task), True
+
+        self.leaders += 1
+        self._waiters[key] = 0
+        # Run detached so a disconnecting leader does not cancel the call for its waiters
+        task = asyncio.ensure_future(self._execute(key, fn))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._calls[key] = task
+        return await asyncio.shield(task), False
+
+    async def _execute(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            # Every waiter would otherwise have paid for its own upstream call
+            self.seconds_saved += (time.monotonic() - started) * self._waiters.pop(key, 0)
+            self._calls.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": singleflight_enabled,
+            "in_flight": len(self._calls),
+            "waiting": sum(self._waiters.values()),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "max_waiters": self.max_waiters,
+            "seconds_saved": round(self.seconds_saved, 3)
+        }
+
+inflight = SingleFlight()
+
+LANES = ("critical", "standard", "interactive")
+LANE_ALIASES = {
+    "critical": "critical", "high": "critical", "urgent": "critical",
+    "standard": "standard", "medium": "standard", "normal": "standard", "low": "standard", "alert": "standard",
+    "interactive": "interactive", "chat": "interactive"
+}
+
+def resolve_lane(value: Optional[str]) -> str:
+    """Map a request priority (field or header) onto a scheduler lane"""
+    if value:
+        lane = LANE_ALIASES.get(value.strip().lower())
+        if lane:
+            return lane
+    return LANE_ALIASES.get(scheduler_default_lane, "standard")
+
+class QueueFullError(Exception):
+    def __init__(self, backend: str, lane: str, retry_after: float, reason: str):
+        super().__init__(f"{backend} {lane} queue {reason}")
+        self.backend = backend
+        self.lane = lane
+        self.retry_after = retry_after
+        self.reason = reason
+
+class PriorityScheduler:
+    """Bounded-concurrency gate with weighted fair dequeueing across bounded priority lanes"""
+
+    def __init__(self, name: str, concurrency: int, weights: Dict[str, int], limits: Dict[str, int]):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.weights = {lane: max(1, weights.get(lane, 1)) for lane in LANES}
+        self.limits = {lane: max(0, limits.get(lane, 0)) for lane in LANES}  # 0 = unbounded
+        self.active = 0
+        self._completions: deque = deque(maxlen=10000)
+        self._rejected: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._queues: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._current: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._dispatched: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._recent_waits: Dict[str, deque] = {lane: deque(maxlen=500) for lane in LANES}
+        self._max_wait: Dict[str, float] = {lane: 0.0 for lane in LANES}
+
+    def depth(self, lane: Optional[str] = None) -> int:
+        if lane:
+            return len(self._queues[lane])
+        return sum(len(q) for q in self._queues.values())
+
+    async def acquire(self, lane: str) -> None:
+        """Wait for an upstream slot; callers must pair this with release()"""
+        enqueued = time.monotonic()
+        if self.active < self.concurrency and self.depth() == 0:
+            self.active += 1
+        else:
+            self._admit(lane)
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues[lane].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Slot was granted just as we were cancelled: hand it on
+                    self.release()
+                else:
+                    try:
+                        self._queues[lane].remove(waiter)
+                    except ValueError:
+                        pass
+                raise
+        self._record(lane, time.monotonic() - enqueued)
+
+    def _admit(self, lane: str) -> None:
+        """Reject instead of queuing when the lane is full or the wait would outlast ADMISSION_MAX_WAIT"""
+        reason = None
+        if self.limits[lane] and len(self._queues[lane]) >= self.limits[lane]:
+            reason = "full"
+        elif admission_max_wait > 0:
+            wait = self.estimated_wait(lane)
+            if wait is not None and wait > admission_max_wait:
+                reason = "wait"
+        if reason:
+            self._rejected[lane] += 1
+            ADMISSION_REJECTIONS.labels(self.name, lane, reason).inc()
+            raise QueueFullError(self.name, lane, self.retry_after(lane), reason)
+
+    def throughput(self) -> float:
+        """Completions per second over the recent window; 0 until there is enough to measure"""
+        now = time.monotonic()
+        while self._completions and now - self._completions[0] > admission_window:
+            self._completions.popleft()
+        if len(self._completions) < 3:
+            return 0.0
+        return len(self._completions) / max(now - self._completions[0], 1.0)
+
+    def estimated_wait(self, lane: str) -> Optional[float]:
+        """Seconds until a new request in `lane` would start, given its weighted share of throughput"""
+        rate = self.throughput()
+        if rate <= 0:
+            return None
+        competing = sum(self.weights[l] for l in LANES if self._queues[l] or l == lane)
+        return (len(self._queues[lane]) + 1) / (rate * self.weights[lane] / competing)
+
+    def retry_after(self, lane: str) -> float:
+        wait = self.estimated_wait(lane)
+        return min(admission_max_retry_after, max(1.0, wait if wait is not None else admission_retry_after))
+
+    def release(self) -> None:
+        self.active -= 1
+        self._completions.append(time.monotonic())
+        while self.active < self.concurrency:
+            lane = self._next_lane()
+            if lane is None:
+                break
+            waiter = self._queues[lane].popleft()
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, lane: str):
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _record(self, lane: str, waited: float) -> None:
+        self._dispatched[lane] += 1
+        self._recent_waits[lane].append(waited)
+        self._max_wait[lane] = max(self._max_wait[lane], waited)
+
+    def _next_lane(self) -> Optional[str]:
+        """Smooth weighted round-robin over lanes that have waiters"""
+        ready = [lane for lane in LANES if self._queues[lane]]
+        if not ready:
+            return None
+        total = 0
+        for lane in ready:
+            self._current[lane] += self.weights[lane]
+            total += self.weights[lane]
+        chosen = max(ready, key=lambda lane: self._current[lane])
+        self._current[chosen] -= total
+        return chosen
+
+    def stats(self) -> Dict[str, Any]:
+        lanes = {}
+        for lane in LANES:
+            waits = sorted(self._recent_waits[lane])
+            lanes[lane] = {
+                "weight": self.weights[lane],
+                "queued": len(self._queues[lane]),
+                "limit": self.limits[lane],
+                "rejected": self._rejected[lane],
+                "dispatched": self._dispatched[lane],
+                "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "wait_max_ms": round(self._max_wait[lane] * 1000, 1)
+            }
+        return {"concurrency": self.concurrency, "active": self.active, "queued": self.depth(),
+                "throughput_per_s": round(self.throughput(), 3), "lanes": lanes}
+
+class OllamaReplica:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        self.consecutive_ejections = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.served = 0
+        self.errors = 0
+        self.healthy: Optional[bool] = None
+        self.loaded_models: List[str] = []
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def has_loaded(self, model: str) -> bool:
+        return any(same_model(name, model) for name in self.loaded_models)
+
+class ReplicaPool:
+    """Least-outstanding-requests routing across Ollama replicas with model affinity"""
+
+    def __init__(self, urls: List[str]):
+        self.replicas = [OllamaReplica(url) for url in urls]
+
+    def acquire(self, model: str, exclude: Optional[List[OllamaReplica]] = None) -> OllamaReplica:
+        """Lease the best replica for `model`; callers must pair this with release()"""
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r not in (exclude or [])] or self.replicas
+        available = [r for r in candidates if r.available(now)]
+        if not available:
+            # Everything is ejected: fail open to the replica that is closest to re-admission
+            available = [min(candidates, key=lambda r: r.ejected_until)]
+        # A replica that already has the model in memory avoids a multi-second load
+        replica = min(available, key=lambda r: (
+            r.outstanding - (ollama_affinity_weight if r.has_loaded(model) else 0), random.random()))
+        replica.outstanding += 1
+        return replica
+
+    def release(self, replica: OllamaReplica, ok: Optional[bool], model: Optional[str] = None) -> None:
+        """Return a lease; ok=None (e.g. cancelled) says nothing about replica health"""
+        replica.outstanding -= 1
+        if ok is None:
+            return
+        if ok:
+            replica.failures = 0
+            replica.consecutive_ejections = 0
+            replica.served += 1
+            if model and not replica.has_loaded(model):
+                replica.loaded_models.append(model)
+            return
+        replica.errors += 1
+        replica.failures += 1
+        if replica.failures >= ollama_eject_after and len(self.replicas) > 1:
+            backoff = ollama_eject_seconds * (2 ** min(replica.consecutive_ejections, 5))
+            replica.ejected_until = time.monotonic() + backoff
+            replica.consecutive_ejections += 1
+            replica.ejections += 1
+            replica.failures = 0
+            logger.warning(f"Ejecting Ollama replica {replica.url} for {backoff:.0f}s after repeated failures")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [{
+            "url": r.url,
+            "outstanding": r.outstanding,
+            "ejected": not r.available(now),
+            "ejected_for_seconds": round(max(0.0, r.ejected_until - now), 1),
+            "ejections": r.ejections,
+            "served": r.served,
+            "errors": r.errors,
+            "healthy": r.healthy,
+            "loaded_models": r.loaded_models
+        } for r in self.replicas]
+
+ollama_pool = ReplicaPool(ollama_urls)
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"Circuit open for {provider}")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens on a high error or slow-call rate over the last calls; one trial call when half-open"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes: deque = deque(maxlen=breaker_window)  # (failed, slow)
+        self._trial_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + breaker_open_seconds - time.monotonic())
+
+    def rejecting(self) -> bool:
+        """True while open and the cool-down has not elapsed (does not start a trial)"""
+        return self.state == "open" and self.retry_after() > 0
+
+    def _allow(self) -> bool:
+        if self.state == "open":
+            if self.retry_after() > 0:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def _record(self, failed: bool, elapsed: float, slow: bool = False) -> None:
+        slow = slow or elapsed >= breaker_slow_seconds
+        if self.state == "half_open":
+            self._trial_in_flight = False
+            if failed or slow:
+                self._trip("trial call failed")
+            else:
+                self.state = "closed"
+                self._outcomes.clear()
+                logger.info(f"Circuit for {self.name} closed")
+            return
+        self._outcomes.append((failed, slow))
+        calls = len(self._outcomes)
+        if calls < breaker_min_calls:
+            return
+        errors = sum(1 for failed, _ in self._outcomes if failed)
+        slows = sum(1 for _, slow in self._outcomes if slow)
+        if errors / calls >= breaker_error_rate:
+            self._trip(f"error rate {errors}/{calls}")
+        elif slows / calls >= breaker_slow_rate:
+            self._trip(f"slow-call rate {slows}/{calls}")
+
+    def _trip(self, reason: str) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._outcomes.clear()
+        logger.warning(f"Circuit for {self.name} opened ({reason}); failing fast for {breaker_open_seconds:.0f}s")
+
+    def admit(self) -> None:
+        """Start a call outside call() (e.g. a stream), whose outcome is passed to report()"""
+        if not self._allow():
+            self.rejected += 1
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def report(self, failed: Optional[bool], elapsed: float, slow: bool = False) -> None:
+        """Outcome of an admitted call; failed is None when it never finished (cancelled, caller left)"""
+        if failed is not None:
+            self._record(failed, elapsed, slow)
+        elif slow or elapsed >= breaker_slow_seconds:
+            # An unfinished call only counts as slow (past the threshold, or beaten by a hedge)
+            self._record(False, elapsed, slow=True)
+        elif self.state == "half_open":
+            self._trial_in_flight = False  # the next call becomes the trial
+
+    async def call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.admit()
+        started = time.monotonic()
+        try:
+            result = await fn()
+        except HTTPException as e:
+            # Client errors (bad request, unknown model) say nothing about backend health
+            self.report(e.status_code >= 500 or e.status_code == 429, time.monotonic() - started)
+            raise
+        except asyncio.CancelledError as e:
+            # Lost a hedge race or the caller went away
+            self.report(None, time.monotonic() - started, slow=HEDGE_LOST in e.args)
+            raise
+        except Exception:
+            self.report(True, time.monotonic() - started)
+            raise
+        self.report(False, time.monotonic() - started)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        calls = len(self._outcomes)
+        return {
+            "state": self.state,
+            "retry_after_seconds": round(self.retry_after(), 1) if self.state == "open" else 0.0,
+            "window_calls": calls,
+            "window_errors": sum(1 for failed, _ in self._outcomes if failed),
+            "window_slow": sum(1 for _, slow in self._outcomes if slow),
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+HEDGE_LOST = "hedge lost"  # cancellation message for the slower call of a hedged pair
+
+breakers = {"ollama": CircuitBreaker("ollama"), "deepseek": CircuitBreaker("deepseek")}
+failover_stats = {"failovers": 0, "hedges": 0, "hedge_wins": 0}
+
+schedulers = {
+    "ollama": PriorityScheduler("ollama", ollama_concurrency * len(ollama_pool.replicas), scheduler_weights,
+                                admission_queue_limits),
+    "deepseek": PriorityScheduler("deepseek", deepseek_concurrency, scheduler_weights, admission_queue_limits)
+}
+
+def load_tokenizer() -> None:
+    """Load the optional local tokenizer once; without it counts use a heuristic"""
+    global tokenizer
+    if not tokenizer_name:
+        return
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        logger.info(f"Loaded tokenizer {tokenizer_name} for token accounting")
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer {tokenizer_name}: {str(e)}; using heuristic token counts")
+
+_token_pieces = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+# Recent counts keyed by a digest of the text, so large logs and prompts are not kept alive
+_token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+def count_tokens(text: str) -> int:
+    """Token count from the local tokenizer, or a BPE-like estimate (memoized by digest)"""
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = _count_tokens(text)
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+def _count_tokens(text: str) -> int:
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    # BPE vocabularies split long words, digit runs (IPs, ports, PIDs) and punctuation into
+    # several pieces, so whitespace word counts understate log lines badly
+    total = 0
+    for piece in _token_pieces.findall(text):
+        if piece.isalpha():
+            total += max(1, (len(piece) + 4) // 5)
+        elif piece.isdigit():
+            total += max(1, (len(piece) + 2) // 3)
+        else:
+            total += 1
+    return total
+
+def size_context(prompt_tokens: int, num_predict: int) -> int:
+    """Smallest context bucket that fits prompt and completion, so Ollama does not truncate"""
+    needed = prompt_tokens + num_predict
+    num_ctx = max(ollama_min_ctx, -(-needed // ollama_ctx_step) * ollama_ctx_step)
+    if num_ctx > ollama_max_ctx:
+        logger.warning(f"Prompt needs {needed} tokens but OLLAMA_MAX_CTX is {ollama_max_ctx}; "
+                       f"Ollama will truncate the prompt")
+        num_ctx = ollama_max_ctx
+    return num_ctx
+
+def default_routing_policy() -> Dict[str, Any]:
+    return {
+        "default": {"model": routing_small_model},
+        "rules": [
+            {"name": "forced-8b", "when": {"model_contains": "foundation-sec-8b-force"},
+             "route": {"model": routing_large_model}},
+            {"name": "critical-lane", "when": {"lane": ["critical"]},
+             "route": {"model": routing_large_model}},
+            {"name": "high-severity", "when": {"severity_min": 12, "queue_depth_max": 4},
+             "route": {"model": routing_large_model}},
+            {"name": "interactive-chat", "when": {"lane": ["interactive"]},
+             "route": {"model": routing_small_model, "num_predict": 192}}
+        ]
+    }
+
+class RoutingPolicy:
+    """Ordered routing rules (first match wins) choosing model, num_predict and num_ctx.
+
+    Reloaded when ROUTING_POLICY_FILE changes (checked at most once a second) or replaced
+    through PUT /routing/policy; an invalid policy is rejected and the current one kept.
+    """
+
+    CONDITIONS = ("model_contains", "lane", "caller", "severity_min", "severity_max",
+                  "prompt_tokens_min", "prompt_tokens_max", "queue_depth_min", "queue_depth_max")
+    ROUTE_KEYS = ("model", "num_predict", "num_ctx")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.policy = self.validate(default_routing_policy())
+        self.source = "built-in"
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self.recent: deque = deque(maxlen=200)
+        self.decisions = 0
+        self.reloads = 0
+        self.reload_errors = 0
+
+    @classmethod
+    def validate(cls, policy: Any) -> Dict[str, Any]:
+        if not isinstance(policy, dict) or not isinstance(policy.get("rules", []), list):
+            raise ValueError("policy must be an object with a 'rules' list")
+        default = policy.get("default") or {}
+        if not isinstance(default, dict) or not default.get("model"):
+            raise ValueError("policy 'default' must name a model")
+        for route in [default] + [rule.get("route") for rule in policy.get("rules", []) if isinstance(rule, dict)]:
+            if not isinstance(route, dict) or set(route) - set(cls.ROUTE_KEYS):
+                raise ValueError(f"routes may only set {', '.join(cls.ROUTE_KEYS)}")
+            if "model" in route and not (isinstance(route["model"], str) and route["model"]):
+                raise ValueError("route 'model' must be a non-empty string")
+            for key in ("num_predict", "num_ctx"):
+                value = route.get(key)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value <= 0):
+                    raise ValueError(f"route '{key}' must be a positive integer, got {value!r}")
+        for number, rule in enumerate(policy.get("rules", []), start=1):
+            if not isinstance(rule, dict) or not isinstance(rule.get("when", {}), dict):
+                raise ValueError(f"rule {number} must be an object with a 'when' object")
+            unknown = set(rule.get("when", {})) - set(cls.CONDITIONS)
+            if unknown:
+                raise ValueError(f"rule {number}: unknown condition(s) {', '.join(sorted(unknown))}")
+            for condition, expected in rule["when"].items():
+                if condition.endswith(("_min", "_max")):
+                    if isinstance(expected, bool) or not isinstance(expected, (int, float)):
+                        raise ValueError(f"rule {number}: {condition} must be a number, got {expected!r}")
+                elif not (isinstance(expected, str) or (
+                        isinstance(expected, list) and expected and all(isinstance(v, str) for v in expected))):
+                    raise ValueError(f"rule {number}: {condition} must be a string or a list of strings, "
+                                     f"got {expected!r}")
+        return {"default": default, "rules": [
+            {"name": rule.get("name") or f"rule-{number}", "when": rule.get("when", {}), "route": rule["route"]}
+            for number, rule in enumerate(policy.get("rules", []), start=1)]}
+
+    def load(self, policy: Any, source: str) -> None:
+        self.policy = self.validate(policy)
+        self.source = source
+        self.reloads += 1
+        logger.info(f"Routing policy loaded from {source}: {len(self.policy['rules'])} rules")
+
+    def reload_file(self, force: bool = False) -> None:
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if not force and mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.load(json.load(f), self.path)
+        except (OSError, ValueError) as e:
+            self.reload_errors += 1
+            logger.error(f"Routing policy {self.path} rejected, keeping the current policy: {str(e)}")
+            if force:
+                raise
+
+    @staticmethod
+    def _match(when: Dict[str, Any], facts: Dict[str, Any]) -> Optional[List[str]]:
+        """Reasons when every condition holds, else None"""
+        reasons = []
+        for condition, expected in when.items():
+            if condition == "model_contains":
+                needles = expected if isinstance(expected, list) else [expected]
+                ok = any(needle.lower() in facts["model"] for needle in needles)
+                reasons.append(f"model contains {expected!r}")
+            elif condition in ("lane", "caller"):
+                allowed = expected if isinstance(expected, list) else [expected]
+                ok = facts[condition] in allowed
+                reasons.append(f"{condition}={facts[condition]}")
+            else:
+                fact_name, bound = condition.rsplit("_", 1)
+                fact = facts[fact_name]
+                ok = fact is not None and (fact >= expected if bound == "min" else fact <= expected)
+                reasons.append(f"{fact_name}={fact} {'>=' if bound == 'min' else '<='} {expected}")
+            if not ok:
+                return None
+        return reasons or ["unconditional"]
+
+    def decide(self, request: "ChatRequest", lane: str) -> Dict[str, Any]:
+        now = time.monotonic()
+        if now - self._checked >= 1.0:
+            self._checked = now
+            self.reload_file()
+        prompt_tokens = count_tokens(build_ollama_prompt(request.messages))
+        facts = {
+            "model": (request.model or "").lower(),
+            "lane": lane,
+            "caller": request.user,
+            "severity": request.severity,
+            "prompt_tokens": prompt_tokens,
+            "queue_depth": schedulers["ollama"].depth()
+        }
+        route, rule_name, reasons = self.policy["default"], "default", ["no rule matched"]
+        for rule in self.policy["rules"]:
+            matched = self._match(rule["when"], facts)
+            if matched is not None:
+                route, rule_name, reasons = {**self.policy["default"], **rule["route"]}, rule["name"], matched
+                break
+        num_predict = int(route.get("num_predict", ollama_max_predict))
+        if request.max_tokens:
+            num_predict = min(request.max_tokens, num_predict)
+        decision = {
+            "model": route["model"],
+            "num_predict": num_predict,
+            "num_ctx": int(route.get("num_ctx") or size_context(prompt_tokens, num_predict)),
+            "rule": rule_name,
+            "reason": ", ".join(reasons)
+        }
+        self.decisions += 1
+        self.recent.append({**decision, "lane": lane, "caller": request.user, "severity": request.severity,
+                            "prompt_tokens": prompt_tokens, "queue_depth": facts["queue_depth"], "at": time.time()})
+        ROUTE_DECISIONS.labels(rule_name, decision["model"]).inc()
+        logger.info(f"Route -> {decision['model']} (num_predict={num_predict}, num_ctx={decision['num_ctx']}) "
+                    f"by {rule_name}: {decision['reason']}")
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        return {"source": self.source, "file": self.path or None, "rules": len(self.policy["rules"]),
+                "decisions": self.decisions, "reloads": self.reloads, "reload_errors": self.reload_errors}
+
+routing_policy = RoutingPolicy(routing_policy_file)
+
+def route_request(request: "ChatRequest", lane: Optional[str] = None) -> Dict[str, Any]:
+    """Routing decision for an Ollama request, made once per request"""
+    if request._route is None:
+        request._route = routing_policy.decide(request, lane or resolve_lane(request.priority))
+    return request._route
+
+def ollama_usage(part: Dict[str, Any], prompt: str, generated_text: str) -> Tuple[Dict[str, int], Dict[str, float]]:
+    """Usage block from Ollama's eval counters, falling back to local counts"""
+    prompt_tokens = part.get("prompt_eval_count")
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt)
+    completion_tokens = part.get("eval_count")
+    if completion_tokens is None:
+        completion_tokens = count_tokens(generated_text)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    timings: Dict[str, float] = {}
+    prompt_ns = part.get("prompt_eval_duration")
+    eval_ns = part.get("eval_duration")
+    if prompt_ns:
+        timings["prompt_ms"] = round(prompt_ns / 1e6, 1)
+        timings["prompt_tokens_per_second"] = round(prompt_tokens / (prompt_ns / 1e9), 2)
+    if eval_ns:
+        timings["completion_ms"] = round(eval_ns / 1e6, 1)
+        timings["completion_tokens_per_second"] = round(completion_tokens / (eval_ns / 1e9), 2)
+    if part.get("load_duration"):
+        timings["load_ms"] = round(part["load_duration"] / 1e6, 1)
+    if part.get("total_duration"):
+        timings["total_ms"] = round(part["total_duration"] / 1e6, 1)
+    return usage, timings
+
+def record_request(provider: str, model: str, source: str, status: Union[int, str], started: float) -> None:
+    REQUESTS.labels(provider, model, source, str(status)).inc()
+    REQUEST_LATENCY.labels(provider, model, source).observe(time.monotonic() - started)
+
+def record_generation(provider: str, model: str, usage: Dict[str, int], timings: Optional[Dict[str, float]],
+                      ttft: Optional[float] = None) -> None:
+    TOKENS.labels(provider, model, "prompt").inc(usage.get("prompt_tokens", 0))
+    TOKENS.labels(provider, model, "completion").inc(usage.get("completion_tokens", 0))
+    timings = timings or {}
+    if timings.get("completion_tokens_per_second"):
+        TOKENS_PER_SECOND.labels(provider, model).observe(timings["completion_tokens_per_second"])
+    if ttft is None and "prompt_ms" in timings:
+        # Non-streaming: the first token follows model load and prompt evaluation
+        ttft = (timings.get("load_ms", 0.0) + timings["prompt_ms"]) / 1000
+    if ttft is not None:
+        TIME_TO_FIRST_TOKEN.labels(provider, model).observe(ttft)
+
+def record_upstream_error(provider: str, error: Any) -> None:
+    if isinstance(error, int):
+        status = str(error)
+    elif isinstance(error, str):
+        status = error
+    elif isinstance(error, httpx.TimeoutException):
+        status = "timeout"
+    elif isinstance(error, ValueError):
+        status = "invalid_response"
+    else:
+        status = "connection_error"
+    UPSTREAM_ERRORS.labels(provider, status).inc()
+
+class BufferFullError(Exception):
+    pass
+
+class AlertBuffer:
+    """Bounded in-memory ring of pending alerts, mirrored to an append-only segment log.
+
+    Every accepted alert gets a sequence number and is appended to the current segment
+    (`segment-<first seq>.log`, one JSON record per line). Draining leases the oldest alerts;
+    acknowledging a batch's last seq advances the checkpoint, and segments wholly below it
+    are deleted. A lease that is not acknowledged in time is handed out again, and on
+    startup everything above the checkpoint is replayed (at-least-once delivery).
+    """
+
+    def __init__(self, directory: str, capacity: int, segment_bytes: int):
+        self.directory = directory
+        self.capacity = capacity
+        self.segment_bytes = segment_bytes
+        self.ring: deque = deque()
+        self.next_seq = 1
+        self.committed = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.drained = 0
+        self.redelivered = 0
+        self._leased = 0  # records at the front of the ring handed out but not yet acknowledged
+        self._lease_expires = 0.0
+        self._segment = None
+        self._segment_size = 0
+        self._segment_firsts: deque = deque()  # first seq of each segment file, oldest first
+        self._last_fsync = 0.0
+        # File I/O runs in worker threads, one operation at a time, off the event loop
+        self._io_lock = asyncio.Lock()
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"segment-{first_seq:012d}.log")
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                segments.append((int(name[8:-4]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                self.committed = int(f.read().strip() or 0)
+        self.next_seq = self.committed + 1
+        for first_seq, path in self._segments():
+            with open(path, "rb") as f:
+                data = f.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                # Torn final record from a crash: cut it so the next append starts on a fresh line
+                logger.warning(f"Truncating a torn record ({len(data) - complete} bytes) at the end of {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(complete)
+            self._segment_firsts.append(first_seq)
+            for line in data[:complete].splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.next_seq = max(self.next_seq, record["seq"] + 1)
+                if record["seq"] > self.committed:
+                    self.ring.append(record)
+        self._roll(self.next_seq)
+        logger.info(f"Alert buffer: {len(self.ring)} pending alerts replayed from {self.directory}")
+
+    def _roll(self, first_seq: int) -> None:
+        if self._segment:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment.close()
+        if not self._segment_firsts or self._segment_firsts[-1] != first_seq:
+            self._segment_firsts.append(first_seq)
+        self._segment = open(self._segment_path(first_seq), "ab")
+        self._segment_size = self._segment.tell()
+
+    def _write(self, data: bytes, first_seq: int) -> None:
+        if self._segment_size >= self.segment_bytes:
+            self._roll(first_seq)
+        self._segment.write(data)
+        self._segment.flush()
+        self._segment_size += len(data)
+        now = time.monotonic()
+        if now - self._last_fsync >= alert_fsync_interval:
+            os.fsync(self._segment.fileno())
+            self._last_fsync = now
+
+    async def append(self, alerts: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """Buffer a batch atomically; returns the (first, last) sequence numbers"""
+        # Shielded so a disconnecting caller cannot leave a written batch out of the ring
+        return await asyncio.shield(self._append(alerts))
+
+    async def _append(self, alerts: List[Dict[str, Any]]) -> Tuple[int, int]:
+        async with self._io_lock:
+            if len(self.ring) + len(alerts) > self.capacity:
+                self.rejected += len(alerts)
+                raise BufferFullError()
+            first_seq = self.next_seq
+            received_at = time.time()
+            records = [{"seq": first_seq + i, "received_at": received_at, "alert": alert}
+                       for i, alert in enumerate(alerts)]
+            data = "".join(json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+                           for record in records)
+            await asyncio.to_thread(self._write, data.encode("utf-8"), first_seq)
+            self.ring.extend(records)
+            self.next_seq += len(records)
+            self.accepted += len(alerts)
+            return first_seq, self.next_seq - 1
+
+    def drain(self, limit: int) -> List[Dict[str, Any]]:
+        """Lease up to `limit` of the oldest unleased alerts; they stay buffered until acked"""
+        now = time.monotonic()
+        if self._leased and now >= self._lease_expires:
+            logger.warning(f"Lease on {self._leased} drained alerts expired without an ack; redelivering them")
+            self.redelivered += self._leased
+            self._leased = 0
+        batch = list(islice(self.ring, self._leased, self._leased + limit))
+        if batch:
+            self._leased += len(batch)
+            self._lease_expires = now + alert_lease_seconds
+        return batch
+
+    async def ack(self, seq: int) -> int:
+        """Commit every leased alert up to `seq`, checkpointing the log; returns how many"""
+        if seq <= self.committed:
+            return 0
+        if not self._leased or seq > self.ring[self._leased - 1]["seq"]:
+            raise ValueError(f"seq {seq} was not drained (or its lease expired)")
+        count = 0
+        while self.ring and self.ring[0]["seq"] <= seq:
+            self.ring.popleft()
+            count += 1
+        self._leased -= count
+        self.committed = seq
+        self.drained += count
+        await asyncio.shield(self._checkpoint())
+        return count
+
+    async def _checkpoint(self) -> None:
+        async with self._io_lock:
+            # Written under the lock, so concurrent acks land in order
+            await asyncio.to_thread(self._write_checkpoint, self.committed)
+
+    def _write_checkpoint(self, committed: int) -> None:
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        with open(checkpoint + ".tmp", "w") as f:
+            f.write(str(committed))
+        os.replace(checkpoint + ".tmp", checkpoint)
+        # Delete segments wholly below the checkpoint; the last one is still being written
+        while len(self._segment_firsts) > 1 and self._segment_firsts[1] - 1 <= committed:
+            os.remove(self._segment_path(self._segment_firsts.popleft()))
+
+    def query(self, since_seq: int, limit: int, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Peek at pending alerts without draining them"""
+        results = []
+        for record in self.ring:
+            if record["seq"] <= since_seq or not alert_matches(record["alert"], filters):
+                continue
+            results.append(record)
+            if len(results) >= limit:
+                break
+        return results
+
+    def close(self) -> None:
+        if self._segment:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment.close()
+            self._segment = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self.ring),
+            "capacity": self.capacity,
+            "fill_ratio": round(len(self.ring) / self.capacity, 4) if self.capacity else 0.0,
+            "next_seq": self.next_seq,
+            "committed_seq": self.committed,
+            "leased": self._leased,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "drained": self.drained,
+            "redelivered": self.redelivered,
+            "segments": len(self._segment_firsts)
+        }
+
+def alert_field(alert: Dict[str, Any], flat: str, nested: Tuple[str, str]) -> Any:
+    """Read a field from a normalized alert (rule_level) or a raw Wazuh alert (rule.level)"""
+    if flat in alert:
+        return alert[flat]
+    parent = alert.get(nested[0])
+    return parent.get(nested[1]) if isinstance(parent, dict) else None
+
+def alert_matches(alert: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    if filters.get("rule_id") and str(alert_field(alert, "rule_id", ("rule", "id"))) != filters["rule_id"]:
+        return False
+    if filters.get("agent_id") and str(alert_field(alert, "agent_id", ("agent", "id"))) != filters["agent_id"]:
+        return False
+    if filters.get("min_level"):
+        try:
+            level = float(alert_field(alert, "rule_level", ("rule", "level")) or 0)
+        except (TypeError, ValueError):
+            level = 0
+        if level < filters["min_level"]:
+            return False
+    return True
+
+def parse_alerts(body: bytes) -> List[Dict[str, Any]]:
+    """Accept a JSON object, a JSON array, {"alerts": [...]} or NDJSON"""
+    text = body.decode("utf-8").strip()
+    if not text:
+        raise HTTPException(status_code=400, detail="Empty alert payload")
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict) and isinstance(parsed.get("alerts"), list):
+            alerts = parsed["alerts"]
+        elif isinstance(parsed, list):
+            alerts = parsed
+        else:
+            alerts = [parsed]
+    except json.JSONDecodeError:
+        alerts = []
+        for number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                alerts.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid NDJSON on line {number}: {str(e)}")
+    if not all(isinstance(alert, dict) for alert in alerts):
+        raise HTTPException(status_code=400, detail="Each alert must be a JSON object")
+    return alerts
+
+alert_buffer = AlertBuffer(alert_log_dir, alert_buffer_capacity, alert_segment_bytes)
+
+# Normalized field name -> (parent, child) location in a raw Wazuh alert
+ALERT_FIELD_PATHS = {
+    "rule_id": ("rule", "id"),
+    "rule_level": ("rule", "level"),
+    "rule_description": ("rule", "description"),
+    "agent_id": ("agent", "id"),
+    "agent_name": ("agent", "name"),
+    "agent_ip": ("agent", "ip"),
+    "decoder_name": ("decoder", "name"),
+    "srcip": ("data", "srcip")
+}
+# Placeholders the webhook normalizer fills in for absent fields
+MISSING_FIELD_VALUES = ("", "none", "unknown", "custom")
+# Per-delivery fields left out of the whole-alert fallback fingerprint
+UNIQUE_ALERT_FIELDS = ("id", "alert_id", "timestamp", "received_at", "@timestamp")
+
+def alert_fingerprint(alert: Dict[str, Any]) -> str:
+    """Rule level plus the ALERT_FINGERPRINT fields; the whole alert when it has no rule ID or identity"""
+    values = [str(alert_field(alert, name, ALERT_FIELD_PATHS.get(name, ("", "")))) for name in alert_fingerprint_fields]
+    missing = [value.strip().lower() in MISSING_FIELD_VALUES for value in values]
+    rule_id = str(alert_field(alert, "rule_id", ALERT_FIELD_PATHS["rule_id"]) or "")
+    if all(missing) or rule_id.strip().lower() in MISSING_FIELD_VALUES:
+        # Nothing identifies the alert, so only an identical alert is a duplicate
+        content = {key: value for key, value in alert.items() if key not in UNIQUE_ALERT_FIELDS}
+        values = [json.dumps(content, sort_keys=True, default=str)]
+    key = "|".join([str(alert_level(alert))] + values)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def alert_is_high_priority(alert: Dict[str, Any]) -> bool:
+    """The webhook receiver's routing decision, or the rule level for raw Wazuh alerts"""
+    flag = alert.get("requires_immediate_action")
+    if isinstance(flag, bool):
+        return flag
+    return alert_level(alert) >= alert_high_priority_level
+
+class AlertAggregator:
+    """Sliding-window deduplication over a capped map of open fingerprint groups.
+
+    The first alert of a group is forwarded; repeats are suppressed and counted. A group
+    closes once no repeat arrives for `alert_dedup_window` seconds (or after the max window);
+    groups that saw repeats are then emitted once, as an aggregated alert, on the path the
+    first alert took: the high-priority workflow or the standard buffer.
+    """
+
+    def __init__(self):
+        self.groups: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # least recently seen first
+        self.recent: deque = deque(maxlen=100)
+        self.forwarded = 0
+        self.suppressed = 0
+        self.emitted = 0
+        self.escalated = 0
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def observe(self, alert: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.time()
+        fingerprint = alert_fingerprint(alert)
+        group = self.groups.get(fingerprint)
+        if group is None:
+            if len(self.groups) >= alert_dedup_max_groups:
+                # Memory bound: close the least recently seen group early
+                self._close(*self.groups.popitem(last=False))
+            group = {"alert": alert, "count": 0, "first_seen": now, "last_seen": now, "sample_logs": [],
+                     "high_priority": alert_is_high_priority(alert)}
+            self.groups[fingerprint] = group
+        else:
+            self.groups.move_to_end(fingerprint)
+        group["count"] += 1
+        group["last_seen"] = now
+        full_log = alert_field(alert, "full_log", ("", ""))
+        if full_log and len(group["sample_logs"]) < alert_dedup_samples:
+            group["sample_logs"].append(str(full_log))
+        if group["count"] == 1:
+            self.forwarded += 1
+            action = "forward"
+        else:
+            self.suppressed += 1
+            action = "suppress"
+        return {"fingerprint": fingerprint, "action": action, "count": group["count"],
+                "first_seen": group["first_seen"], "last_seen": group["last_seen"]}
+
+    def flush(self, force: bool = False) -> int:
+        now = time.time()
+        expired = [fp for fp, group in self.groups.items()
+                   if force or now - group["last_seen"] >= alert_dedup_window
+                   or now - group["first_seen"] >= alert_dedup_max_window]
+        for fingerprint in expired:
+            self._close(fingerprint, self.groups.pop(fingerprint))
+        return len(expired)
+
+    def _close(self, fingerprint: str, group: Dict[str, Any]) -> None:
+        if group["count"] < 2:
+            return  # the single alert was already forwarded
+        aggregate = {
+            **group["alert"],
+            "aggregated": True,
+            "fingerprint": fingerprint,
+            "count": group["count"],
+            "first_seen": group["first_seen"],
+            "last_seen": group["last_seen"],
+            "sample_logs": group["sample_logs"]
+        }
+        self.recent.append(aggregate)
+        task = asyncio.ensure_future(self._deliver(aggregate, group["high_priority"]))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, aggregate: Dict[str, Any], high_priority: bool) -> None:
+        if high_priority and alert_high_priority_url and http_client is not None:
+            try:
+                response = await http_client.post(alert_high_priority_url, json=aggregate,
+                                                  headers={"X-Source": "foundation-sec-dedup"},
+                                                  timeout=upstream_timeout(30))
+                response.raise_for_status()
+                self.escalated += 1
+                return
+            except httpx.HTTPError as e:
+                logger.warning(f"High-priority aggregate for {aggregate['fingerprint']} not delivered "
+                               f"({str(e) or type(e).__name__}); buffering it instead")
+        try:
+            await alert_buffer.append([aggregate])
+            self.emitted += 1
+        except BufferFullError:
+            self.dropped += 1
+            logger.warning(f"Alert buffer full; aggregate for {aggregate['fingerprint']} "
+                           f"({aggregate['count']} alerts) kept in memory only")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(min(5.0, alert_dedup_window / 4))
+            self.flush()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush(force=True)
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "fingerprint_fields": alert_fingerprint_fields,
+            "window_seconds": alert_dedup_window,
+            "open_groups": len(self.groups),
+            "max_groups": alert_dedup_max_groups,
+            "forwarded": self.forwarded,
+            "suppressed": self.suppressed,
+            "aggregates_emitted": self.emitted,
+            "aggregates_escalated": self.escalated,
+            "aggregates_dropped": self.dropped
+        }
+
+alert_aggregator = AlertAggregator()
+
+def same_model(a: str, b: str) -> bool:
+    """Compare Ollama model names, treating a missing tag as ':latest'"""
+    def norm(name: str) -> str:
+        return name if ":" in name else f"{name}:latest"
+    return norm(a) == norm(b)
+
+class BackendMonitor:
+    """Periodically probes the configured backend so request paths never have to"""
+
+    def __init__(self):
+        self.snapshot: Dict[str, Any] = {
+            "status": "unknown",
+            "backend": ai_provider,
+            "models": [],
+            "loaded_models": [],
+            "checked_at": None,
+            "probe_ms": None,
+            "error": None,
+            "degraded": None
+        }
+        self.refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def age(self) -> Optional[float]:
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    def is_stale(self) -> bool:
+        age = self.age()
+        return age is None or age > health_stale_after
+
+    async def refresh(self) -> None:
+        started = time.monotonic()
+        try:
+            if ai_provider == "deepseek":
+                state = await self._probe_deepseek()
+            else:
+                state = await self._probe_ollama()
+            state["error"] = None
+            state.setdefault("degraded", None)
+        except Exception as e:
+            # Keep the last known model list; only the status changes
+            state = {"status": "unreachable", "error": str(e)}
+        state["probe_ms"] = round((time.monotonic() - started) * 1000, 1)
+        state["checked_at"] = int(time.time())
+        self.snapshot = {**self.snapshot, **state}
+        self.refreshed_at = time.monotonic()
+
+    async def _probe_replica(self, replica: OllamaReplica) -> Tuple[List[str], Optional[str]]:
+        try:
+            response = await http_client.get(f"{replica.url}/api/tags", timeout=upstream_timeout(probe_timeout))
+            if response.status_code != 200:
+                replica.healthy = False
+                return [], f"{replica.url}: HTTP {response.status_code}"
+            models = [model['name'] for model in response.json().get('models', [])]
+            ps = await http_client.get(f"{replica.url}/api/ps", timeout=upstream_timeout(probe_timeout))
+            if ps.status_code == 200:
+                replica.loaded_models = [model['name'] for model in ps.json().get('models', [])]
+            replica.healthy = True
+            return models, None
+        except Exception as e:
+            replica.healthy = False
+            return [], f"{replica.url}: {str(e)}"
+
+    async def _probe_ollama(self) -> Dict[str, Any]:
+        results = await asyncio.gather(*(self._probe_replica(r) for r in ollama_pool.replicas))
+        errors = [error for _, error in results if error]
+        if len(errors) == len(results):
+            raise RuntimeError("; ".join(errors))
+        models: List[str] = []
+        loaded: List[str] = []
+        for (replica_models, _), replica in zip(results, ollama_pool.replicas):
+            models += [name for name in replica_models if name not in models]
+            loaded += [name for name in replica.loaded_models if name not in loaded]
+        state = {"status": "healthy", "models": models, "loaded_models": loaded}
+        if errors:
+            state["degraded"] = errors
+        return state
+
+    async def _probe_deepseek(self) -> Dict[str, Any]:
+        headers = {"Accept": "application/json"}
+        if deepseek_api_key:
+            headers["Authorization"] = f"Bearer {deepseek_api_key}"
+        resp = await http_client.get(f"{deepseek_base}/v1/models", headers=headers,
+                                     timeout=upstream_timeout(probe_timeout))
+        # Consider reachable even if unauthorized, since some free endpoints may not require key
+        if resp.status_code not in (200, 401, 403):
+            return {"status": "unhealthy", "error": f"HTTP {resp.status_code}"}
+        models = [deepseek_default_model, "deepseek-reasoner"]
+        if resp.status_code == 200:
+            models = [model["id"] for model in resp.json().get("data", [])] or models
+        return {"status": "reachable", "models": models, "loaded_models": models}
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(health_refresh_interval)
+            await self.refresh()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+backend_monitor = BackendMonitor()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global http_client
     # Startup
     logger.info("Starting Foundation-Sec API Lite...")
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=upstream_pool_size,
+            max_keepalive_connections=upstream_keepalive,
+        ),
+        timeout=upstream_timeout(ollama_timeout),
+    )
+    logger.info(f"Upstream pool: {upstream_pool_size} connections ({upstream_keepalive} keep-alive)")
+    logger.info(f"Ollama replicas: {ollama_urls}")
+    await asyncio.to_thread(load_tokenizer)
+    routing_policy.reload_file()
     await check_ollama_connection()
+    await asyncio.to_thread(alert_buffer.open)
+    if verdict_store_enabled:
+        await asyncio.to_thread(verdict_store.open)
+        warmed = await asyncio.to_thread(verdict_store.warm, response_cache, verdict_store_warm_entries)
+        logger.info(f"Warmed response cache with {warmed} stored verdicts")
+    if semantic_cache_enabled:
+        await asyncio.to_thread(semantic_cache.open)
+    backend_monitor.start()
+    alert_aggregator.start()
     yield
     # Shutdown
     logger.info("Shutting down...")
+    await backend_monitor.stop()
+    await alert_aggregator.stop()
+    alert_buffer.close()
+    semantic_cache.close()
+    verdict_store.close()
+    await http_client.aclose()
+    http_client = None
 
 async def check_ollama_connection():
-    """Check if Ollama is running and the model is available"""
-    try:
-        # Skip check if provider is DeepSeek
-        if ai_provider != "ollama":
-            logger.info("AI provider is not Ollama; skipping local model check")
-            return
-
-        response = requests.get(f"{ollama_url}/api/tags", timeout=10)
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            model_names = [model['name'] for model in models]
-            logger.info(f"Available models: {model_names}")
+    """Take the first backend snapshot and check the model is available"""
+    await backend_monitor.refresh()
+    state = backend_monitor.snapshot
+    # Skip model check if provider is DeepSeek
+    if ai_provider != "ollama":
+        logger.info(f"AI provider is {ai_provider} ({state['status']}); skipping local model check")
+        return
 
-            if any('foundation-sec' in name for name in model_names):
-                logger.info("Foundation-Sec model found in Ollama!")
-            else:
-                logger.warning("Foundation-Sec model not found. Available models listed above.")
+    if state["status"] == "healthy":
+        logger.info(f"Available models: {state['models']}")
+        if any('foundation-sec' in name for name in state["models"]):
+            logger.info("Foundation-Sec model found in Ollama!")
         else:
-            logger.error(f"Failed to connect to Ollama: {response.status_code}")
-    except Exception as e:
-        logger.error(f"Error connecting to Ollama: {str(e)}")
+            logger.warning("Foundation-Sec model not found. Available models listed above.")
+    else:
+        logger.error(f"Error connecting to Ollama: {state['error']}")
         logger.info("Make sure Ollama container is running: docker ps")
 
 app = FastAPI(
@@ -88,29 +2046,52 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+def health_payload() -> Dict[str, Any]:
+    state = backend_monitor.snapshot
+    age = backend_monitor.age()
+    payload = {
+        "status": state["status"],
+        "model": "foundation-sec",
+        "backend": state["backend"],
+        "checked_at": state["checked_at"],
+        "age_seconds": round(age, 3) if age is not None else None,
+        "stale": backend_monitor.is_stale(),
+        "probe_ms": state["probe_ms"]
+    }
+    if state["backend"] == "deepseek":
+        payload["base"] = deepseek_base
+    if state["error"]:
+        payload["error"] = state["error"]
+    if state["degraded"]:
+        payload["degraded"] = state["degraded"]
+    if state["backend"] == "ollama" and len(ollama_pool.replicas) > 1:
+        payload["replicas"] = ollama_pool.stats()
+    return payload
+
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    try:
-        if ai_provider == "deepseek":
-            # Try to check DeepSeek API availability (model list if available)
-            url = f"{deepseek_base}/v1/models"
-            headers = {"Accept": "application/json"}
-            if deepseek_api_key:
-                headers["Authorization"] = f"Bearer {deepseek_api_key}"
-            resp = requests.get(url, headers=headers, timeout=5)
-            if resp.status_code in (200, 401, 403):
-                # Consider reachable even if unauthorized, since some free endpoints may not require key
-                return {"status": "reachable", "backend": "deepseek", "base": deepseek_base}
-            raise HTTPException(status_code=503, detail="DeepSeek API not responding")
-        # Default: Ollama health
-        response = requests.get(f"{ollama_url}/api/tags", timeout=5)
-        if response.status_code == 200:
-            return {"status": "healthy", "model": "foundation-sec", "backend": "ollama"}
-        else:
-            raise HTTPException(status_code=503, detail="Ollama not responding")
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"Ollama connection failed: {str(e)}")
+    """Health check endpoint (served from the background snapshot)"""
+    payload = health_payload()
+    if payload["status"] not in ("healthy", "reachable") or payload["stale"]:
+        raise HTTPException(status_code=503, detail=payload)
+    return payload
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: the target model is loaded (Ollama) or the API is reachable (DeepSeek)"""
+    payload = health_payload()
+    state = backend_monitor.snapshot
+    if state["backend"] == "deepseek":
+        payload["ready"] = payload["status"] == "reachable"
+    else:
+        payload["ready_model"] = ready_model
+        payload["available"] = any(same_model(name, ready_model) for name in state["models"])
+        payload["loaded"] = any(same_model(name, ready_model) for name in state["loaded_models"])
+        payload["ready"] = payload["status"] == "healthy" and payload["loaded"]
+    payload["ready"] = payload["ready"] and not payload["stale"]
+    if not payload["ready"]:
+        raise HTTPException(status_code=503, detail=payload)
+    return payload
 
 @app.get("/")
 async def root():
@@ -122,134 +2103,1204 @@ async def root():
         "status": "running"
     }
 
+def resolve_provider(request: ChatRequest) -> str:
+    return provider_for_model(request.model)
+
+def provider_for_model(model: Optional[str]) -> str:
+    """Route to provider by env or by model hint"""
+    if model and isinstance(model, str) and model.lower().startswith("deepseek"):
+        return "deepseek"
+    return ai_provider
+
+def deepseek_headers() -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if deepseek_api_key:
+        headers["Authorization"] = f"Bearer {deepseek_api_key}"
+    return headers
+
+def deepseek_model(request: ChatRequest) -> str:
+    """Pass DeepSeek model names through; anything else (e.g. on failover) uses the default"""
+    if request.model and request.model.lower().startswith("deepseek"):
+        return request.model
+    return deepseek_default_model
+
+def build_deepseek_payload(request: ChatRequest, stream: bool) -> Dict[str, Any]:
+    payload = {
+        "model": deepseek_model(request),
+        "messages": [ {"role": m.role, "content": m.content} for m in request.messages ],
+        "max_tokens": min(request.max_tokens if request.max_tokens else 256, 1024),
+        "temperature": request.temperature if request.temperature is not None else 0.7,
+        "stream": stream
+    }
+    if request.response_format:
+        # DeepSeek supports JSON mode but not schemas; the prompt has to describe the shape
+        payload["response_format"] = {"type": "json_object"}
+    return payload
+
+def ollama_format(response_format: Optional[Dict[str, Any]]) -> Any:
+    """Translate an OpenAI-style response_format into Ollama's `format` (JSON mode or a JSON schema)"""
+    if not response_format:
+        return None
+    if response_format.get("type") == "json_schema":
+        schema = (response_format.get("json_schema") or {}).get("schema")
+        return schema or "json"
+    if response_format.get("type") == "json_object":
+        return "json"
+    return None
+
+def build_ollama_prompt(messages: List[ChatMessage]) -> str:
+    """Convert messages to a single prompt"""
+    prompt = ""
+    for message in messages:
+        if message.role == "system":
+            prompt += f"System: {message.content}\n"
+        elif message.role == "user":
+            prompt += f"User: {message.content}\n"
+        elif message.role == "assistant":
+            prompt += f"Assistant: {message.content}\n"
+    prompt += "Assistant: "
+    return prompt
+
+def select_ollama_model(request: ChatRequest, lane: Optional[str] = None) -> str:
+    return route_request(request, lane)["model"]
+
+def build_ollama_payload(request: ChatRequest, prompt: str, route: Dict[str, Any], stream: bool) -> Dict[str, Any]:
+    payload = {
+        "model": route["model"],
+        "prompt": prompt,
+        "stream": stream,
+        "options": {
+            "temperature": request.temperature if request.temperature is not None else 0.7,
+            "num_predict": route["num_predict"],
+            "num_ctx": route["num_ctx"],
+            "top_k": 20,
+            "top_p": 0.9
+        }
+    }
+    output_format = ollama_format(request.response_format)
+    if output_format is not None:
+        payload["format"] = output_format
+    return payload
+
+async def complete_deepseek(request: ChatRequest) -> ChatResponse:
+    """Forward to DeepSeek (OpenAI-compatible)"""
+    payload = build_deepseek_payload(request, stream=False)
+    resp = await http_client.post(f"{deepseek_base}/v1/chat/completions", json=payload,
+                                  headers=deepseek_headers(), timeout=upstream_timeout(deepseek_timeout))
+    if resp.status_code != 200:
+        record_upstream_error("deepseek", resp.status_code)
+        raise HTTPException(status_code=resp.status_code, detail=f"DeepSeek error: {resp.text}")
+    ds = resp.json()
+    usage = ds.get("usage", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+    record_generation("deepseek", payload["model"], usage, None)
+
+    # Normalize to ChatResponse
+    return ChatResponse(
+        id=str(ds.get("id", f"chatcmpl-{int(time.time())}")),
+        created=int(ds.get("created", time.time())),
+        model=str(ds.get("model", payload["model"])),
+        choices=ds.get("choices", []),
+        usage=usage
+    )
+
+async def send_ollama(path: str, payload: Dict[str, Any], stream: bool) -> Tuple[httpx.Response, OllamaReplica]:
+    """Send to the least-loaded replica, failing over on connection errors or 5xx.
+
+    The returned replica is still leased; callers must release it via ollama_pool.release().
+    """
+    tried: List[OllamaReplica] = []
+    attempts = max(1, min(ollama_max_attempts, len(ollama_pool.replicas)))
+    while True:
+        replica = ollama_pool.acquire(payload["model"], exclude=tried)
+        tried.append(replica)
+        upstream_request = http_client.build_request("POST", f"{replica.url}{path}", json=payload,
+                                                     timeout=upstream_timeout(ollama_timeout))
+        try:
+            response = await http_client.send(upstream_request, stream=stream)
+        except asyncio.CancelledError:
+            ollama_pool.release(replica, ok=None)
+            raise
+        except httpx.RequestError as e:
+            ollama_pool.release(replica, ok=False)
+            if len(tried) >= attempts:
+                raise
+            record_upstream_error("ollama", e)
+            logger.warning(f"Ollama replica {replica.url} failed ({str(e)}); retrying on another replica")
+            continue
+        if response.status_code >= 500 and len(tried) < attempts:
+            await response.aclose()
+            ollama_pool.release(replica, ok=False)
+            record_upstream_error("ollama", response.status_code)
+            logger.warning(f"Ollama replica {replica.url} returned {response.status_code}; retrying on another replica")
+            continue
+        return response, replica
+
+async def complete_ollama(request: ChatRequest, lane: str) -> ChatResponse:
+    prompt = build_ollama_prompt(request.messages)
+    route = route_request(request, lane)
+    selected_model = route["model"]
+    ollama_request = build_ollama_payload(request, prompt, route, stream=False)
+
+    response, replica = await send_ollama("/api/generate", ollama_request, stream=False)
+    ollama_pool.release(replica, ok=response.status_code < 500, model=selected_model)
+    if response.status_code != 200:
+        record_upstream_error("ollama", response.status_code)
+        raise HTTPException(status_code=response.status_code, detail=f"Ollama request failed: {response.text}")
+
+    ollama_response = response.json()
+    generated_text = ollama_response.get('response', '')
+    usage, timings = ollama_usage(ollama_response, prompt, generated_text)
+    record_generation("ollama", selected_model, usage, timings)
+
+    return ChatResponse(
+        id=f"chatcmpl-{hash(prompt) % 1000000}",
+        created=int(time.time()),
+        model=request.model or selected_model,
+        choices=[{
+            "index": 0,
+            "message": {"role": "assistant", "content": generated_text},
+            "finish_reason": "length" if ollama_response.get("done_reason") == "length" else "stop"
+        }],
+        usage=usage,
+        timings=timings
+    )
+
+def sse_event(data: Any) -> str:
+    """Format one server-sent event frame"""
+    if not isinstance(data, str):
+        data = json.dumps(data, separators=(",", ":"))
+    return f"data: {data}\n\n"
+
+def completion_chunk(chunk_id: str, created: int, model: str, delta: Dict[str, Any],
+                     finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+async def open_upstream_stream(method: str, url: str, payload: Dict[str, Any], headers: Optional[Dict[str, str]],
+                               timeout: float, provider: str, label: str) -> httpx.Response:
+    """Send a streaming request and fail with an HTTP error before any SSE bytes are sent"""
+    upstream_request = http_client.build_request(method, url, json=payload, headers=headers,
+                                                 timeout=upstream_timeout(timeout))
+    response = await http_client.send(upstream_request, stream=True)
+    if response.status_code != 200:
+        record_upstream_error(provider, response.status_code)
+        body = await response.aread()
+        await response.aclose()
+        raise HTTPException(status_code=response.status_code,
+                            detail=f"{label} request failed: {body.decode(errors='replace')}")
+    return response
+
+def stream_failed(error: BaseException) -> Optional[bool]:
+    """Breaker outcome of a stream that failed to open; None when the caller went away"""
+    return None if isinstance(error, asyncio.CancelledError) else is_backend_failure(error)
+
+def report_stream(breaker: CircuitBreaker, status: Union[int, str], opened: float, started: float,
+                  ttft: Optional[float]) -> None:
+    """Breaker outcome of a finished stream; a healthy stream is slow only if its first token was"""
+    elapsed = (started + ttft if ttft is not None else time.monotonic()) - opened
+    breaker.report(None if status == 499 else status != 200, elapsed)
+
+async def stream_ollama(request: ChatRequest, lane: str) -> StreamingResponse:
+    """Relay Ollama's NDJSON token stream as OpenAI chat.completion.chunk events"""
+    started = time.monotonic()
+    prompt = build_ollama_prompt(request.messages)
+    route = route_request(request, lane)
+    selected_model = route["model"]
+    ollama_request = build_ollama_payload(request, prompt, route, stream=True)
+    scheduler, breaker = schedulers["ollama"], breakers["ollama"]
+    await scheduler.acquire(lane)
+    try:
+        breaker.admit()
+    except CircuitOpenError:
+        scheduler.release()
+        raise
+    opened = time.monotonic()
+    try:
+        response, replica = await send_ollama("/api/generate", ollama_request, stream=True)
+    except BaseException as e:
+        scheduler.release()
+        breaker.report(stream_failed(e), time.monotonic() - opened)
+        raise
+    if response.status_code != 200:
+        body = await response.aread()
+        await response.aclose()
+        ollama_pool.release(replica, ok=response.status_code < 500)
+        scheduler.release()
+        breaker.report(response.status_code >= 500 or response.status_code == 429, time.monotonic() - opened)
+        record_upstream_error("ollama", response.status_code)
+        raise HTTPException(status_code=response.status_code,
+                            detail=f"Ollama request failed: {body.decode(errors='replace')}")
+    chunk_id = f"chatcmpl-{hash(prompt) % 1000000}"
+    created = int(time.time())
+    model = request.model or selected_model
+
+    async def events():
+        generated: List[str] = []
+        ttft: Optional[float] = None
+        status: Union[int, str] = 499  # until the stream ends on its own; otherwise the client left
+        IN_FLIGHT.inc()
+        try:
+            yield sse_event(completion_chunk(chunk_id, created, model, {"role": "assistant"}))
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    part = json.loads(line)
+                except ValueError as e:
+                    logger.error(f"Ollama stream sent invalid JSON: {line[:200]!r}")
+                    status = "upstream_error"
+                    record_upstream_error("ollama", e)
+                    yield sse_event({"error": {"message": "Invalid response from model service",
+                                               "type": "upstream_error"}})
+                    break
+                if part.get("error"):
+                    status = "upstream_error"
+                    record_upstream_error("ollama", "stream_error")
+                    yield sse_event({"error": {"message": part["error"], "type": "upstream_error"}})
+                    break
+                if part.get("response"):
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    generated.append(part["response"])
+                    yield sse_event(completion_chunk(chunk_id, created, model, {"content": part["response"]}))
+                if part.get("done"):
+                    finish_reason = "length" if part.get("done_reason") == "length" else "stop"
+                    final = completion_chunk(chunk_id, created, model, {}, finish_reason)
+                    final["usage"], final["timings"] = ollama_usage(part, prompt, "".join(generated))
+                    record_generation("ollama", selected_model, final["usage"], final["timings"], ttft)
+                    status = 200
+                    yield sse_event(final)
+                    break
+            if status == 499:
+                # Upstream closed the stream without its final part
+                status = "upstream_error"
+                record_upstream_error("ollama", "stream_error")
+                yield sse_event({"error": {"message": "Model service ended the stream early",
+                                           "type": "upstream_error"}})
+            yield sse_event("[DONE]")
+        except httpx.RequestError as e:
+            logger.error(f"Ollama stream error: {str(e)}")
+            status = "upstream_error"
+            record_upstream_error("ollama", e)
+            yield sse_event({"error": {"message": "Model service unavailable", "type": "upstream_error"}})
+        finally:
+            await response.aclose()
+            ollama_pool.release(replica, ok=status != "upstream_error", model=selected_model)
+            scheduler.release()
+            IN_FLIGHT.dec()
+            report_stream(breaker, status, opened, started, ttft)
+            record_request("ollama", selected_model, "upstream", status, started)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={**SSE_HEADERS, "X-Served-By": "ollama"})
+
+async def stream_deepseek(request: ChatRequest, lane: str) -> StreamingResponse:
+    """Relay DeepSeek's SSE stream (already OpenAI-formatted) as it arrives"""
+    started = time.monotonic()
+    payload = build_deepseek_payload(request, stream=True)
+    scheduler, breaker = schedulers["deepseek"], breakers["deepseek"]
+    await scheduler.acquire(lane)
+    try:
+        breaker.admit()
+    except CircuitOpenError:
+        scheduler.release()
+        raise
+    opened = time.monotonic()
+    try:
+        response = await open_upstream_stream("POST", f"{deepseek_base}/v1/chat/completions", payload,
+                                              deepseek_headers(), deepseek_timeout, "deepseek", "DeepSeek")
+    except BaseException as e:
+        scheduler.release()
+        breaker.report(stream_failed(e), time.monotonic() - opened)
+        raise
+
+    async def events():
+        ttft: Optional[float] = None
+        status: Union[int, str] = 499  # until the stream ends on its own; otherwise the client left
+        IN_FLIGHT.inc()
+        try:
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    if ttft is None and '"content"' in line:
+                        ttft = time.monotonic() - started
+                        TIME_TO_FIRST_TOKEN.labels("deepseek", payload["model"]).observe(ttft)
+                    yield f"{line}\n\n"
+            status = 200
+        except httpx.RequestError as e:
+            logger.error(f"DeepSeek stream error: {str(e)}")
+            status = "upstream_error"
+            record_upstream_error("deepseek", e)
+            yield sse_event({"error": {"message": "Model service unavailable", "type": "upstream_error"}})
+        finally:
+            await response.aclose()
+            scheduler.release()
+            IN_FLIGHT.dec()
+            report_stream(breaker, status, opened, started, ttft)
+            record_request("deepseek", payload["model"], "upstream", status, started)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={**SSE_HEADERS, "X-Served-By": "deepseek"})
+
+_whitespace = re.compile(r"\s+")
+
+def cache_key(request: ChatRequest, provider: str, model: str) -> str:
+    """Fingerprint of the normalized messages, routed model and generation parameters"""
+    normalized = {
+        "provider": provider,
+        "upstream_model": model,
+        "model": (request.model or "").strip().lower(),
+        "messages": [[m.role.strip().lower(), _whitespace.sub(" ", m.content).strip()] for m in request.messages],
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "response_format": request.response_format
+    }
+    encoded = json.dumps(normalized, separators=(",", ":"), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def is_cacheable(request: ChatRequest) -> bool:
+    if not cache_enabled or request.stream:
+        return False
+    return cache_all_temperatures or request.temperature == 0
+
+def upstream_model(request: ChatRequest, provider: str, lane: Optional[str] = None) -> str:
+    """Model name actually sent upstream (bounded label cardinality for metrics)"""
+    if provider == "deepseek":
+        return deepseek_model(request)
+    return select_ollama_model(request, lane)
+
+async def call_provider(request: ChatRequest, provider: str, lane: str) -> ChatResponse:
+    async with schedulers[provider].slot(lane):
+        if provider == "deepseek":
+            result = await breakers[provider].call(lambda: complete_deepseek(request))
+        else:
+            # Default: use Ollama
+            result = await breakers[provider].call(lambda: complete_ollama(request, lane))
+    result.provider = provider
+    return result
+
+def fallback_for(provider: str) -> Optional[str]:
+    if failover_provider and failover_provider != provider and failover_provider in breakers:
+        return failover_provider
+    return None
+
+def is_backend_failure(error: BaseException) -> bool:
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (httpx.RequestError, CircuitOpenError))
+
+async def complete(request: ChatRequest, provider: str, lane: str) -> ChatResponse:
+    """Complete on `provider`, failing over (or hedging after a deadline) to the fallback provider"""
+    fallback = fallback_for(provider)
+    if fallback is None:
+        return await call_provider(request, provider, lane)
+    if breakers[provider].rejecting():
+        failover_stats["failovers"] += 1
+        return await call_provider(request, fallback, lane)
+
+    primary = asyncio.ensure_future(call_provider(request, provider, lane))
+    attempted = {provider}
+    try:
+        if hedge_after_seconds > 0:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_after_seconds)
+            if not done:
+                attempted.add(fallback)
+                return await hedge(request, primary, fallback, lane)
+        return await primary
+    except Exception as e:
+        if not is_backend_failure(e) or fallback in attempted:
+            raise
+        logger.warning(f"{provider} failed ({str(e) or type(e).__name__}); failing over to {fallback}")
+        failover_stats["failovers"] += 1
+        return await call_provider(request, fallback, lane)
+    finally:
+        if not primary.done():
+            primary.cancel()
+
+async def hedge(request: ChatRequest, primary: asyncio.Future, fallback: str, lane: str) -> ChatResponse:
+    """Race the slow primary against the fallback provider; the first success wins"""
+    failover_stats["hedges"] += 1
+    secondary = asyncio.ensure_future(call_provider(request, fallback, lane))
+    pending = {primary, secondary}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is secondary:
+                        failover_stats["hedge_wins"] += 1
+                    for loser in pending:
+                        loser.cancel(HEDGE_LOST)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def serve_completion(request: ChatRequest, provider: str, lane: str, use_cache: bool) -> Tuple[ChatResponse, str]:
+    """Exact cache lookup, then a coalesced semantic lookup or upstream call; returns (response, source)"""
+    model = upstream_model(request, provider, lane)
+    key = cache_key(request, provider, model)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return ChatResponse(**cached), "cache"
+        if verdict_store_enabled:
+            cached = await asyncio.to_thread(verdict_store.get, key)
+            if cached is not None:
+                response_cache.put(key, cached)
+                return ChatResponse(**cached), "store"
+
+    async def fetch() -> Tuple[ChatResponse, str]:
+        # Runs once per key when coalescing, so a burst makes one embedding call, not one per request
+        probe = None
+        if use_cache and semantic_cache_enabled:
+            cached, probe = await semantic_cache.lookup(request, provider, model)
+            if cached is not None:
+                response_cache.put(key, cached)
+                return ChatResponse(**cached), "semantic"
+        result = await complete(request, provider, lane)
+        if use_cache:
+            response_cache.put(key, result.model_dump())
+            if verdict_store_enabled:
+                await asyncio.to_thread(verdict_store.put, key, result.model_dump())
+            if probe is not None:
+                semantic_cache.add(probe[0], probe[1], result.model_dump())
+        return result, "upstream"
+
+    if not singleflight_enabled:
+        return await fetch()
+    (result, source), shared = await inflight.run(key, fetch)
+    return result, "coalesced" if shared else source
+
+def cache_header(source: str, use_cache: bool) -> str:
+    """X-Cache value for a serve_completion source"""
+    labels = {"cache": "HIT", "store": "STORE", "semantic": "SEMANTIC"}
+    return labels.get(source, "MISS" if use_cache else "BYPASS")
+
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, response: Response,
+                           x_cache_bypass: Optional[str] = Header(None),
+                           x_priority: Optional[str] = Header(None),
+                           x_caller: Optional[str] = Header(None)):
     """OpenAI-compatible chat completions endpoint"""
+    target_provider = resolve_provider(request)
+    lane = resolve_lane(request.priority or x_priority)
+    request.user = request.user or x_caller
+    if compaction_enabled:
+        tokens_before, tokens_after = await compact_request(request, target_provider, lane)
+        if tokens_after < tokens_before:
+            response.headers["X-Prompt-Compacted"] = f"{tokens_before}->{tokens_after}"
+    model_label = upstream_model(request, target_provider, lane)
+    started = time.monotonic()
+    source = "upstream"
+    status = 200
+    if not request.stream:
+        IN_FLIGHT.inc()
     try:
-        # Route to provider by env or by model hint
-        target_provider = ai_provider
-        if request.model and isinstance(request.model, str) and request.model.lower().startswith("deepseek"):
-            target_provider = "deepseek"
-
-        if target_provider == "deepseek":
-            # Forward to DeepSeek (OpenAI-compatible)
-            ds_model = request.model or deepseek_default_model
-            payload = {
-                "model": ds_model,
-                "messages": [ {"role": m.role, "content": m.content} for m in request.messages ],
-                "max_tokens": min(request.max_tokens if request.max_tokens else 256, 1024),
-                "temperature": request.temperature if request.temperature is not None else 0.7,
-                "stream": False
-            }
-            url = f"{deepseek_base}/v1/chat/completions"
-            headers = {"Content-Type": "application/json"}
-            if deepseek_api_key:
-                headers["Authorization"] = f"Bearer {deepseek_api_key}"
-
-            resp = requests.post(url, json=payload, headers=headers, timeout=60)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=resp.status_code, detail=f"DeepSeek error: {resp.text}")
-            ds = resp.json()
-
-            # Normalize to ChatResponse
-            return ChatResponse(
-                id=str(ds.get("id", f"chatcmpl-{int(time.time())}")),
-                created=int(ds.get("created", time.time())),
-                model=str(ds.get("model", ds_model)),
-                choices=ds.get("choices", []),
-                usage=ds.get("usage", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
-            )
+        if request.stream:
+            if breakers[target_provider].rejecting():
+                fallback = fallback_for(target_provider)
+                if fallback is None:
+                    raise CircuitOpenError(target_provider, breakers[target_provider].retry_after())
+                failover_stats["failovers"] += 1
+                target_provider, model_label = fallback, upstream_model(request, fallback, lane)
+            if target_provider == "deepseek":
+                return await stream_deepseek(request, lane)
+            return await stream_ollama(request, lane)
 
-        # Default: use Ollama
-        # Convert messages to a single prompt
-        prompt = ""
-        for message in request.messages:
-            if message.role == "system":
-                prompt += f"System: {message.content}\n"
-            elif message.role == "user":
-                prompt += f"User: {message.content}\n"
-            elif message.role == "assistant":
-                prompt += f"Assistant: {message.content}\n"
-        prompt += "Assistant: "
-
-        # Memory-efficient defaults
-        selected_model = "tinyllama:latest"
-        if hasattr(request, 'model') and request.model and 'foundation-sec-8b-force' in request.model.lower():
-            selected_model = "bogdancsn/foundation-sec-8b:latest"
-
-        ollama_request = {
-            "model": selected_model,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "temperature": request.temperature if request.temperature else 0.7,
-                "num_predict": min(request.max_tokens if request.max_tokens else 256, 256),
-                "num_ctx": 2048,
-                "top_k": 20,
-                "top_p": 0.9
-            }
-        }
+        bypass = (x_cache_bypass or "").lower() in ("1", "true", "yes")
+        use_cache = not bypass and is_cacheable(request)
+        result, source = await serve_completion(request, target_provider, lane, use_cache)
+        response.headers["X-Cache"] = cache_header(source, use_cache)
+        if source == "coalesced":
+            response.headers["X-Coalesced"] = "true"
+        if request._route is not None:
+            response.headers["X-Route"] = request._route["rule"]
+        if result.provider:
+            response.headers["X-Served-By"] = result.provider
+            if result.provider != target_provider:
+                target_provider, model_label = result.provider, upstream_model(request, result.provider, lane)
+        return result
 
-        response = requests.post(f"{ollama_url}/api/generate", json=ollama_request, timeout=60)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"Ollama request failed: {response.text}")
-
-        ollama_response = response.json()
-        generated_text = ollama_response.get('response', '')
-
-        return ChatResponse(
-            id=f"chatcmpl-{hash(prompt) % 1000000}",
-            created=int(time.time()),
-            model=request.model or selected_model,
-            choices=[{
-                "index": 0,
-                "message": {"role": "assistant", "content": generated_text},
-                "finish_reason": "stop"
-            }],
-            usage={
-                "prompt_tokens": len(prompt.split()),
-                "completion_tokens": len(generated_text.split()),
-                "total_tokens": len(prompt.split()) + len(generated_text.split())
-            }
-        )
-        
-    except requests.RequestException as e:
-        logger.error(f"Ollama request error: {str(e)}")
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except CircuitOpenError as e:
+        status = 503
+        raise HTTPException(status_code=503, detail=f"{e.provider} circuit open; failing fast",
+                            headers={"Retry-After": str(max(1, int(e.retry_after + 0.5)))})
+    except QueueFullError as e:
+        status = 429
+        raise queue_full_response(e)
+    except httpx.RequestError as e:
+        logger.error(f"Upstream request error: {str(e)}")
+        record_upstream_error(target_provider, e)
+        status = 503
         raise HTTPException(status_code=503, detail="Model service unavailable")
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}")
         import traceback
         logger.error(f"Full traceback: {traceback.format_exc()}")
+        status = 500
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        # Streams that opened are recorded when they end, with their real outcome
+        if not request.stream:
+            IN_FLIGHT.dec()
+            record_request(target_provider, model_label, source, status, started)
+        elif status != 200:
+            record_request(target_provider, model_label, source, status, started)
+
+compaction_stats = {"messages": 0, "tokens_before": 0, "tokens_after": 0, "map_reduce": 0, "map_reduce_failures": 0}
+
+def compact_lines(text: str) -> List[str]:
+    """Noise-stripped log lines with repeats folded into the first occurrence (order kept)"""
+    counts: "OrderedDict[str, list]" = OrderedDict()
+    for raw in text.splitlines():
+        line = " ".join(_noise_tokens.sub("*", raw).split())
+        if not line:
+            continue
+        key = strip_volatile(line)
+        if key in counts:
+            counts[key][1] += 1
+        else:
+            counts[key] = [line, 1]
+    return [line if n == 1 else f"{line} [x{n}]" for line, n in counts.values()]
+
+def clip_line(line: str, max_tokens: int) -> str:
+    """Keep the head and tail characters of one over-long line"""
+    tokens = count_tokens(line)
+    if tokens <= max_tokens:
+        return line
+    keep = int(len(line) * max_tokens / tokens)
+    while True:
+        keep = max(16, int(keep * 0.8))  # leave room for the marker; counts are not linear in length
+        head = int(keep * compaction_head_ratio)
+        clipped = f"{line[:head]} ...[{len(line) - keep} chars omitted]... {line[len(line) - (keep - head):]}"
+        if keep == 16 or count_tokens(clipped) <= max_tokens:
+            return clipped
+
+def fit_lines(lines: List[str], budget: int) -> str:
+    """Join lines, keeping the head and tail of the log when it exceeds `budget` tokens"""
+    head_budget = int(budget * compaction_head_ratio)
+    # Clip single lines so one huge line (e.g. a syscheck diff) cannot crowd out the head or tail
+    lines = [clip_line(line, max(8, min(head_budget, budget - head_budget) - 1)) for line in lines]
+    costs = [count_tokens(line) + 1 for line in lines]
+    if sum(costs) <= budget:
+        return "\n".join(lines)
+    head, used = 0, 0
+    while head < len(lines) and used + costs[head] <= head_budget - 8:  # 8 tokens for the omission marker
+        used += costs[head]
+        head += 1
+    tail, used = 0, 0
+    while tail < len(lines) - head and used + costs[-1 - tail] <= budget - head_budget:
+        used += costs[-1 - tail]
+        tail += 1
+    omitted = len(lines) - head - tail
+    return "\n".join(lines[:head] + [f"...[{omitted} lines omitted]..."] + (lines[-tail:] if tail else []))
+
+def compact_log(text: str, budget: int) -> str:
+    return fit_lines(compact_lines(text), budget)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "Summarize this part of a security log for an analyst in at most three sentences. Keep "
+    "usernames, IP addresses, file paths, process names, error messages and counts; drop the rest."
+)
+
+async def summarize_chunks(lines: List[str], provider: str, lane: str) -> Optional[str]:
+    """Map-reduce: summarize log chunks in parallel, then join the summaries in order"""
+    chunks: List[List[str]] = [[]]
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if chunks[-1] and used + cost > map_reduce_chunk_tokens:
+            chunks.append([])
+            used = 0
+        chunks[-1].append(line)
+        used += cost
+    if len(chunks) > map_reduce_max_chunks:
+        # Keep the opening and closing chunks; the middle of a long log is the least informative
+        keep_head = max(1, int(map_reduce_max_chunks * compaction_head_ratio))
+        chunks = chunks[:keep_head] + chunks[-(map_reduce_max_chunks - keep_head):]
+    requests = [ChatRequest(
+        model="foundation-sec",
+        messages=[ChatMessage(role="system", content=SUMMARY_SYSTEM_PROMPT),
+                  ChatMessage(role="user", content="\n".join(chunk))],
+        max_tokens=map_reduce_summary_tokens,
+        temperature=0
+    ) for chunk in chunks]
+    outcomes = await asyncio.gather(*(serve_completion(r, provider, lane, use_cache=cache_enabled) for r in requests),
+                                    return_exceptions=True)
+    summaries = []
+    for number, outcome in enumerate(outcomes, start=1):
+        if isinstance(outcome, BaseException):
+            logger.warning(f"Chunk summary {number}/{len(chunks)} failed: {str(outcome) or type(outcome).__name__}")
+            compaction_stats["map_reduce_failures"] += 1
+            return None
+        result, _ = outcome
+        text = result.choices[0]["message"]["content"].strip() if result.choices else ""
+        summaries.append(f"[part {number}/{len(chunks)}] {text}")
+    compaction_stats["map_reduce"] += 1
+    return "\n".join(summaries)
+
+async def compact_text(text: str, budget: int, provider: str, lane: str) -> str:
+    tokens = count_tokens(text)
+    if tokens <= budget:
+        return text
+    lines = compact_lines(text)
+    if map_reduce_enabled and tokens >= map_reduce_min_tokens:
+        summary = await summarize_chunks(lines, provider, lane)
+        if summary is not None:
+            lines = summary.splitlines()
+    compacted = fit_lines(lines, budget)
+    compaction_stats["messages"] += 1
+    compaction_stats["tokens_before"] += tokens
+    compaction_stats["tokens_after"] += count_tokens(compacted)
+    return compacted
+
+async def compact_request(request: ChatRequest, provider: str, lane: str) -> Tuple[int, int]:
+    """Compact oversized user messages in place; returns (tokens before, tokens after)"""
+    before = after = 0
+    for message in request.messages:
+        if message.role != "user":
+            continue
+        tokens = count_tokens(message.content)
+        before += tokens
+        if tokens > compaction_token_budget:
+            message.content = await compact_text(message.content, compaction_token_budget, provider, lane)
+            tokens = count_tokens(message.content)
+        after += tokens
+    return before, after
+
+BATCH_SYSTEM_PROMPT = (
+    "You are a senior security analyst triaging Wazuh alerts. For every numbered alert, "
+    "assess the threat and recommend response steps. Reply with only a JSON array containing "
+    "one object per alert, in order: "
+    '{"index": <alert number>, "threat_level": "critical|high|medium|low", '
+    '"recommended_actions": ["..."], "summary": "<one sentence>"}'
+)
+THREAT_LEVELS = ("critical", "high", "medium", "low")
+PACK_VERDICT_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer"},
+            "threat_level": {"type": "string", "enum": list(THREAT_LEVELS)},
+            "recommended_actions": {"type": "array", "items": {"type": "string"}},
+            "summary": {"type": "string"}
+        },
+        "required": ["index", "threat_level", "recommended_actions", "summary"]
+    }
+}
+
+def render_alert(number: int, alert: Dict[str, Any], log_tokens: int) -> str:
+    """Templated one-alert block with the full_log compacted to `log_tokens`"""
+    full_log = compact_log(str(alert_field(alert, "full_log", ("", "")) or ""), log_tokens)
+    fields = [
+        ("rule", f"{alert_field(alert, 'rule_id', ('rule', 'id'))} level "
+                 f"{alert_field(alert, 'rule_level', ('rule', 'level'))}: "
+                 f"{alert_field(alert, 'rule_description', ('rule', 'description'))}"),
+        ("agent", f"{alert_field(alert, 'agent_name', ('agent', 'name'))} "
+                  f"({alert_field(alert, 'agent_ip', ('agent', 'ip'))})"),
+        ("location", alert.get("location")),
+        ("decoder", alert_field(alert, "decoder_name", ("decoder", "name"))),
+        ("log", full_log.replace("\n", "\n    "))
+    ]
+    lines = [f"Alert {number}:"] + [f"  {name}: {value}" for name, value in fields if value not in (None, "", "None")]
+    return "\n".join(lines)
+
+def pack_alerts(alerts: List[Dict[str, Any]]) -> List[List[int]]:
+    """Greedily group alert indexes so each pack fits the prompt and completion budgets"""
+    per_pack = max(1, min(batch_max_alerts, ollama_max_predict // max(1, batch_tokens_per_verdict)))
+    budget = batch_prompt_tokens - count_tokens(BATCH_SYSTEM_PROMPT)
+    packs: List[List[int]] = []
+    current: List[int] = []
+    used = 0
+    for index, alert in enumerate(alerts):
+        cost = count_tokens(render_alert(len(current) + 1, alert, batch_log_tokens))
+        if current and (len(current) >= per_pack or used + cost > budget):
+            packs.append(current)
+            current, used = [], 0
+        current.append(index)
+        used += cost
+    if current:
+        packs.append(current)
+    return packs
+
+def alert_level(alert: Dict[str, Any]) -> int:
+    try:
+        return int(float(alert_field(alert, "rule_level", ("rule", "level")) or 0))
+    except (TypeError, ValueError):
+        return 0
+
+admission_stats = {"degraded_verdicts": 0}
+
+def should_degrade(provider: str) -> bool:
+    return degraded_mode and schedulers[provider].depth() >= degrade_queue_depth
+
+def heuristic_verdict(alert: Dict[str, Any]) -> Dict[str, Any]:
+    """Severity from the Wazuh rule level when the model gives no usable verdict"""
+    level = alert_level(alert)
+    if level >= 12:
+        threat, actions = "critical", ["Isolate affected host", "Escalate to incident response"]
+    elif level >= 8:
+        threat, actions = "high", ["Investigate source", "Review related events"]
+    elif level >= 5:
+        threat, actions = "medium", ["Review alert context"]
+    else:
+        threat, actions = "low", ["Monitor"]
+    return {"threat_level": threat, "recommended_actions": actions, "summary": "", "source": "heuristic"}
+
+def parse_pack_verdicts(text: str, count: int) -> Dict[int, Dict[str, Any]]:
+    """Map 1-based alert numbers to verdicts from the model's JSON array"""
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    verdicts: Dict[int, Dict[str, Any]] = {}
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            continue
+        try:
+            number = int(item.get("index", position))
+        except (TypeError, ValueError):
+            number = position
+        threat = str(item.get("threat_level", "")).lower()
+        if not 1 <= number <= count or threat not in THREAT_LEVELS:
+            continue
+        actions = item.get("recommended_actions") or []
+        verdicts[number] = {
+            "threat_level": threat,
+            "recommended_actions": [str(a) for a in actions] if isinstance(actions, list) else [str(actions)],
+            "summary": str(item.get("summary", "")),
+            "source": "model"
+        }
+    return verdicts
+
+async def analyze_pack(alerts: List[Dict[str, Any]], indexes: List[int], model: str,
+                       provider: str, lane: str) -> Tuple[List[Dict[str, Any]], Dict[str, int], Optional[str]]:
+    prompt = "\n\n".join(render_alert(number, alerts[i], batch_log_tokens) for number, i in enumerate(indexes, start=1))
+    request = ChatRequest(
+        model=model,
+        messages=[ChatMessage(role="system", content=BATCH_SYSTEM_PROMPT), ChatMessage(role="user", content=prompt)],
+        max_tokens=batch_tokens_per_verdict * len(indexes),
+        temperature=0,
+        severity=max(alert_level(alerts[i]) for i in indexes),
+        response_format={"type": "json_schema", "json_schema": {"name": "alert_verdicts", "schema": PACK_VERDICT_SCHEMA}}
+    )
+    request._alerts = [alerts[i] for i in indexes]
+    try:
+        result, _ = await serve_completion(request, provider, lane, use_cache=cache_enabled)
+    except (HTTPException, CircuitOpenError, QueueFullError, httpx.RequestError) as e:
+        logger.warning(f"Batch pack of {len(indexes)} alerts failed: {str(e) or type(e).__name__}")
+        return [heuristic_verdict(alerts[i]) for i in indexes], {}, None
+    text = result.choices[0]["message"]["content"] if result.choices else ""
+    parsed = parse_pack_verdicts(text, len(indexes))
+    verdicts = [parsed.get(number) or heuristic_verdict(alerts[i]) for number, i in enumerate(indexes, start=1)]
+    return verdicts, result.usage, result.provider
+
+@app.post("/alerts/analyze")
+async def analyze_alerts(request: AlertAnalysisRequest, x_priority: Optional[str] = Header(None)):
+    """Triage many alerts with few LLM calls; verdicts are returned in input order"""
+    if not request.alerts:
+        raise HTTPException(status_code=400, detail="No alerts supplied")
+    if len(request.alerts) > alert_max_batch:
+        raise HTTPException(status_code=413, detail=f"Batch of {len(request.alerts)} exceeds ALERT_MAX_BATCH={alert_max_batch}")
+    started = time.monotonic()
+    provider = provider_for_model(request.model)
+    lane = resolve_lane(request.priority or x_priority)
+
+    # Alerts sharing a fingerprint and log (up to PIDs, ports and timestamps) get one verdict
+    representative: Dict[Tuple[str, str], int] = {}
+    duplicate_of: List[int] = []
+    for i, alert in enumerate(request.alerts):
+        key = (alert_fingerprint(alert), strip_volatile(str(alert_field(alert, "full_log", ("", "")) or "")))
+        duplicate_of.append(representative.setdefault(key, i))
+    unique = [i for i, rep_index in enumerate(duplicate_of) if rep_index == i]
+
+    unique_count = len(unique)
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(request.alerts)
+    if should_degrade(provider):
+        # Under load, low-severity alerts get the rule-level verdict and never reach the queue
+        kept = []
+        for i in unique:
+            if alert_level(request.alerts[i]) < degrade_below_level:
+                results[i] = {"index": i, "alert_id": request.alerts[i].get("alert_id", request.alerts[i].get("id")),
+                              "pack": None, "verdict": {**heuristic_verdict(request.alerts[i]), "source": "degraded"}}
+                DEGRADED_VERDICTS.inc()
+                admission_stats["degraded_verdicts"] += 1
+            else:
+                kept.append(i)
+        unique = kept
+    unique_alerts = [request.alerts[i] for i in unique]
+
+    packs = pack_alerts(unique_alerts)
+    outcomes = await asyncio.gather(*(
+        analyze_pack(unique_alerts, indexes, request.model, provider, lane) for indexes in packs))
+
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    providers = set()
+    for pack_number, (indexes, (verdicts, pack_usage, served_by)) in enumerate(zip(packs, outcomes)):
+        for u, verdict in zip(indexes, verdicts):
+            i = unique[u]
+            results[i] = {"index": i, "alert_id": request.alerts[i].get("alert_id", request.alerts[i].get("id")),
+                          "pack": pack_number, "verdict": verdict}
+        for field in usage:
+            usage[field] += int(pack_usage.get(field, 0) or 0)
+        if served_by:
+            providers.add(served_by)
+    for i, rep_index in enumerate(duplicate_of):
+        if rep_index != i:
+            results[i] = {**results[rep_index], "index": i, "duplicate_of": rep_index,
+                          "alert_id": request.alerts[i].get("alert_id", request.alerts[i].get("id"))}
+    return {
+        "results": results,
+        "alerts": len(request.alerts),
+        "unique_alerts": unique_count,
+        "degraded": unique_count - len(unique),
+        "packs": len(packs),
+        "providers": sorted(providers),
+        "usage": usage,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+    }
+
+VERDICT_ACTIONS = ("block_ip", "isolate_host", "disable_account", "manual_investigation", "send_notification", "monitor")
+VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "threat_level": {"type": "string", "enum": list(THREAT_LEVELS)},
+        "actions": {"type": "array", "items": {"type": "string", "enum": list(VERDICT_ACTIONS)}, "maxItems": 4},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "rationale": {"type": "string", "maxLength": 240}
+    },
+    "required": ["threat_level", "actions", "confidence", "rationale"]
+}
+VERDICT_SYSTEM_PROMPT = (
+    "You are a senior security analyst. Assess the alert and reply with only a JSON object: "
+    '{"threat_level": "critical|high|medium|low", "actions": [zero or more of '
+    + ", ".join(VERDICT_ACTIONS) + '], "confidence": <0 to 1>, "rationale": "<one short sentence>"}'
+)
+# Typed actions for the rule-level fallback
+HEURISTIC_ACTIONS = {
+    "critical": ["isolate_host", "send_notification"],
+    "high": ["manual_investigation", "send_notification"],
+    "medium": ["manual_investigation"],
+    "low": ["monitor"]
+}
+
+def rule_level_verdict(alert: Dict[str, Any], source: str) -> Dict[str, Any]:
+    threat = heuristic_verdict(alert)["threat_level"]
+    return {"threat_level": threat, "actions": HEURISTIC_ACTIONS[threat], "confidence": 0.3,
+            "rationale": "Derived from the Wazuh rule level; no model verdict was available.", "source": source}
+
+def parse_verdict(text: str) -> Optional[Dict[str, Any]]:
+    """Validate the model's JSON verdict; None when it is unusable"""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        item = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    threat = str(item.get("threat_level", "")).lower()
+    if threat not in THREAT_LEVELS:
+        return None
+    actions = item.get("actions") or []
+    try:
+        confidence = min(1.0, max(0.0, float(item.get("confidence", 0.5))))
+    except (TypeError, ValueError):
+        confidence = 0.5
+    return {
+        "threat_level": threat,
+        "actions": [a for a in dict.fromkeys(str(a).lower() for a in actions) if a in VERDICT_ACTIONS]
+                   if isinstance(actions, list) else [],
+        "confidence": round(confidence, 3),
+        "rationale": str(item.get("rationale", ""))[:240],
+        "source": "model"
+    }
+
+@app.post("/v1/verdict")
+async def verdict(request: VerdictRequest, response: Response, x_priority: Optional[str] = Header(None)):
+    """Compact typed verdict for one alert via schema-constrained generation"""
+    if not request.alert and not request.prompt:
+        raise HTTPException(status_code=400, detail="Supply an alert or a prompt")
+    started = time.monotonic()
+    provider = provider_for_model(request.model)
+    lane = resolve_lane(request.priority or x_priority)
+    if request.alert and should_degrade(provider) and alert_level(request.alert) < degrade_below_level:
+        DEGRADED_VERDICTS.inc()
+        admission_stats["degraded_verdicts"] += 1
+        response.headers["X-Degraded"] = "true"
+        return {**rule_level_verdict(request.alert, "degraded"), "usage": {},
+                "elapsed_seconds": round(time.monotonic() - started, 3)}
+    chat = ChatRequest(
+        model=request.model,
+        messages=[ChatMessage(role="system", content=VERDICT_SYSTEM_PROMPT),
+                  ChatMessage(role="user", content=render_alert(1, request.alert, compaction_log_tokens)
+                              if request.alert else request.prompt)],
+        max_tokens=verdict_max_tokens,
+        temperature=0,
+        severity=alert_level(request.alert) if request.alert else None,
+        response_format={"type": "json_schema", "json_schema": {"name": "verdict", "schema": VERDICT_SCHEMA}}
+    )
+    if request.alert:
+        chat._alerts = [request.alert]
+    usage: Dict[str, int] = {}
+    try:
+        result, source = await serve_completion(chat, provider, lane, use_cache=cache_enabled)
+        response.headers["X-Cache"] = cache_header(source, cache_enabled)
+        if source == "coalesced":
+            response.headers["X-Coalesced"] = "true"
+        usage = result.usage
+        if result.provider:
+            response.headers["X-Served-By"] = result.provider
+        text = result.choices[0]["message"]["content"] if result.choices else ""
+        parsed = parse_verdict(text)
+        if parsed is None:
+            logger.warning(f"Unusable verdict from {result.model}: {text[:200]!r}")
+    except QueueFullError as e:
+        if not (request.alert and degraded_mode):
+            raise queue_full_response(e)
+        DEGRADED_VERDICTS.inc()
+        admission_stats["degraded_verdicts"] += 1
+        response.headers["X-Degraded"] = "true"
+        return {**rule_level_verdict(request.alert, "degraded"), "usage": {},
+                "elapsed_seconds": round(time.monotonic() - started, 3)}
+    except (HTTPException, CircuitOpenError, httpx.RequestError) as e:
+        if not request.alert:
+            if isinstance(e, HTTPException):
+                raise
+            raise HTTPException(status_code=503, detail="Model service unavailable")
+        logger.warning(f"Verdict generation failed: {str(e) or type(e).__name__}; using rule level")
+        parsed = None
+    if parsed is None:
+        if not request.alert:
+            raise HTTPException(status_code=502, detail="Model returned no usable verdict")
+        parsed = rule_level_verdict(request.alert, "heuristic")
+    return {**parsed, "usage": usage, "elapsed_seconds": round(time.monotonic() - started, 3)}
+
+class GatewayCollector:
+    """Exports queue, cache, coalescing and backend state at scrape time"""
+
+    def collect(self):
+        cache = response_cache.stats()
+        hits = CounterMetricFamily("gateway_cache_hits", "Response cache hits")
+        hits.add_metric([], cache["hits"])
+        misses = CounterMetricFamily("gateway_cache_misses", "Response cache misses")
+        misses.add_metric([], cache["misses"])
+        ratio = GaugeMetricFamily("gateway_cache_hit_ratio", "Response cache hit ratio")
+        ratio.add_metric([], cache["hit_ratio"])
+        cache_bytes = GaugeMetricFamily("gateway_cache_bytes", "Response cache memory in use")
+        cache_bytes.add_metric([], cache["bytes_used"])
+        yield from (hits, misses, ratio, cache_bytes)
+
+        coalesced = CounterMetricFamily("gateway_coalesced_requests", "Requests served by another in-flight call")
+        coalesced.add_metric([], inflight.coalesced)
+        yield coalesced
+
+        depth = GaugeMetricFamily("gateway_queue_depth", "Requests waiting for an upstream slot",
+                                  labels=["provider", "lane"])
+        active = GaugeMetricFamily("gateway_upstream_active", "Upstream calls holding a slot", labels=["provider"])
+        for name, scheduler in schedulers.items():
+            active.add_metric([name], scheduler.active)
+            for lane in LANES:
+                depth.add_metric([name, lane], scheduler.depth(lane))
+        yield from (depth, active)
+
+        outstanding = GaugeMetricFamily("gateway_replica_outstanding", "Requests in flight per Ollama replica",
+                                        labels=["replica"])
+        ejected = GaugeMetricFamily("gateway_replica_ejected", "1 while an Ollama replica is ejected",
+                                    labels=["replica"])
+        now = time.monotonic()
+        for replica in ollama_pool.replicas:
+            outstanding.add_metric([replica.url], replica.outstanding)
+            ejected.add_metric([replica.url], 0 if replica.available(now) else 1)
+        yield from (outstanding, ejected)
+
+        breaker_open = GaugeMetricFamily("gateway_circuit_open", "1 while a provider circuit is open or half-open",
+                                         labels=["provider"])
+        for name, breaker in breakers.items():
+            breaker_open.add_metric([name], 0 if breaker.state == "closed" else 1)
+        failovers = CounterMetricFamily("gateway_failovers", "Requests served by the failover provider")
+        failovers.add_metric([], failover_stats["failovers"])
+        hedges = CounterMetricFamily("gateway_hedged_requests", "Requests hedged to the failover provider",
+                                     labels=["winner"])
+        hedges.add_metric(["fallback"], failover_stats["hedge_wins"])
+        hedges.add_metric(["primary"], failover_stats["hedges"] - failover_stats["hedge_wins"])
+        yield from (breaker_open, failovers, hedges)
+
+        buffer = alert_buffer.stats()
+        pending = GaugeMetricFamily("gateway_alert_buffer_pending", "Alerts waiting in the ingest buffer")
+        pending.add_metric([], buffer["pending"])
+        buffered = CounterMetricFamily("gateway_alert_buffer_alerts", "Alerts offered to the ingest buffer",
+                                       labels=["outcome"])
+        for outcome in ("accepted", "rejected", "drained"):
+            buffered.add_metric([outcome], buffer[outcome])
+        yield from (pending, buffered)
+
+        dedup = alert_aggregator.stats()
+        deduped = CounterMetricFamily("gateway_alert_dedup", "Alerts seen by the deduplication stage",
+                                      labels=["action"])
+        deduped.add_metric(["forward"], dedup["forwarded"])
+        deduped.add_metric(["suppress"], dedup["suppressed"])
+        groups = GaugeMetricFamily("gateway_alert_dedup_open_groups", "Open deduplication windows")
+        groups.add_metric([], dedup["open_groups"])
+        yield from (deduped, groups)
+
+        up = GaugeMetricFamily("gateway_backend_up", "Backend reachable at last probe", labels=["backend"])
+        state = backend_monitor.snapshot
+        up.add_metric([state["backend"]], 1 if state["status"] in ("healthy", "reachable") else 0)
+        yield up
+
+REGISTRY.register(GatewayCollector())
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/alerts", status_code=202)
+async def buffer_alerts(request: Request, response: Response):
+    """Buffer standard-severity alerts (single JSON alert, JSON array or NDJSON batch)"""
+    alerts = parse_alerts(await request.body())
+    if len(alerts) > alert_max_batch:
+        raise HTTPException(status_code=413, detail=f"Batch of {len(alerts)} exceeds ALERT_MAX_BATCH={alert_max_batch}")
+    try:
+        first_seq, last_seq = await alert_buffer.append(alerts)
+    except BufferFullError:
+        raise HTTPException(status_code=429, detail="Alert buffer full; retry later",
+                            headers={"Retry-After": str(alert_retry_after)})
+    stats = alert_buffer.stats()
+    response.headers["X-Buffer-Fill"] = str(stats["fill_ratio"])
+    return {"status": "buffered", "accepted": len(alerts), "first_seq": first_seq, "last_seq": last_seq,
+            "pending": stats["pending"], "capacity": stats["capacity"]}
+
+@app.get("/alerts")
+async def query_alerts(since_seq: int = 0, limit: int = 100, rule_id: Optional[str] = None,
+                       agent_id: Optional[str] = None, min_level: Optional[float] = None):
+    """Peek at buffered alerts without removing them"""
+    filters = {"rule_id": rule_id, "agent_id": agent_id, "min_level": min_level}
+    records = alert_buffer.query(since_seq, max(1, min(limit, 1000)), filters)
+    return {"alerts": records, "count": len(records), "pending": len(alert_buffer.ring)}
+
+@app.post("/alerts/drain")
+async def drain_alerts(max_alerts: int = 500, ack: Optional[int] = None):
+    """Lease the oldest buffered alerts; `ack` commits a previous batch up to its last_seq"""
+    if ack is not None:
+        try:
+            await alert_buffer.ack(ack)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    records = alert_buffer.drain(max(0, min(max_alerts, alert_max_batch)))
+    return {"alerts": records, "count": len(records), "last_seq": records[-1]["seq"] if records else None,
+            "pending": len(alert_buffer.ring), "committed_seq": alert_buffer.committed,
+            "lease_seconds": alert_lease_seconds}
+
+@app.get("/alerts/stats")
+async def alert_stats():
+    return {**alert_buffer.stats(), "dedup": alert_aggregator.stats()}
+
+@app.post("/alerts/dedup")
+async def dedup_alerts(request: Request):
+    """Sliding-window deduplication: tells the caller which alerts to forward"""
+    alerts = parse_alerts(await request.body())
+    decisions = [alert_aggregator.observe(alert) for alert in alerts]
+    if len(decisions) == 1:
+        return decisions[0]
+    return {"decisions": decisions, "forward": sum(1 for d in decisions if d["action"] == "forward")}
+
+@app.get("/alerts/aggregates")
+async def recent_aggregates(limit: int = 50):
+    """Most recently closed aggregated alerts (also written to the alert buffer)"""
+    aggregates = list(alert_aggregator.recent)[-max(1, limit):]
+    return {"aggregates": aggregates[::-1], "open_groups": len(alert_aggregator.groups)}
+
+@app.get("/stats")
+async def stats():
+    """Gateway runtime statistics"""
+    return {
+        "cache": response_cache.stats(),
+        "verdict_store": verdict_store.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "singleflight": inflight.stats(),
+        "scheduler": {name: scheduler.stats() for name, scheduler in schedulers.items()},
+        "replicas": ollama_pool.stats(),
+        "breakers": {name: breaker.stats() for name, breaker in breakers.items()},
+        "routing": routing_policy.stats(),
+        "admission": {"max_wait_seconds": admission_max_wait, "degraded_mode": degraded_mode,
+                      "degrade_below_level": degrade_below_level, "degrade_queue_depth": degrade_queue_depth,
+                      **admission_stats},
+        "compaction": {"enabled": compaction_enabled, "token_budget": compaction_token_budget,
+                       "map_reduce": map_reduce_enabled, **compaction_stats},
+        "alert_buffer": alert_buffer.stats(),
+        "alert_dedup": alert_aggregator.stats(),
+        "failover": {"provider": failover_provider or None, "hedge_after_seconds": hedge_after_seconds,
+                     **failover_stats}
+    }
+
+@app.delete("/cache")
+async def clear_cache():
+    """Drop all cached responses"""
+    response_cache.clear()
+    if verdict_store_enabled:
+        await asyncio.to_thread(verdict_store.clear)
+    if semantic_cache_enabled:
+        semantic_cache.clear()
+    return {"status": "cleared"}
+
+@app.get("/routing")
+async def routing():
+    """Active routing policy and the most recent decisions"""
+    return {**routing_policy.stats(), "policy": routing_policy.policy,
+            "recent_decisions": list(routing_policy.recent)[-20:][::-1]}
+
+@app.put("/routing/policy")
+async def replace_routing_policy(request: Request):
+    """Swap the routing policy at runtime (kept until the policy file next changes)"""
+    try:
+        routing_policy.load(json.loads(await request.body()), "api")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid routing policy: {str(e)}")
+    return routing_policy.stats()
+
+@app.post("/routing/reload")
+async def reload_routing_policy():
+    """Re-read ROUTING_POLICY_FILE"""
+    if not routing_policy.path:
+        raise HTTPException(status_code=400, detail="ROUTING_POLICY_FILE is not set")
+    try:
+        routing_policy.reload_file(force=True)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Routing policy rejected: {str(e)}")
+    return routing_policy.stats()
 
 @app.get("/models")
 async def list_models():
-    """List available models"""
-    try:
-        if ai_provider == "deepseek":
-            # Return a static list for DeepSeek
-            models = [
-                {"id": deepseek_default_model, "object": "model", "created": 0, "owned_by": "deepseek"},
-                {"id": "deepseek-reasoner", "object": "model", "created": 0, "owned_by": "deepseek"}
-            ]
-            return {"object": "list", "data": models}
-
-        response = requests.get(f"{ollama_url}/api/tags", timeout=10)
-        if response.status_code == 200:
-            ollama_models = response.json().get('models', [])
-            models = []
-            for model in ollama_models:
-                models.append({
-                    "id": model['name'],
-                    "object": "model",
-                    "created": 0,
-                    "owned_by": "ollama"
-                })
-            return {"object": "list", "data": models}
-        else:
-            raise HTTPException(status_code=503, detail="Cannot fetch models from Ollama")
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"Error fetching models: {str(e)}")
+    """List available models (served from the background snapshot)"""
+    state = backend_monitor.snapshot
+    if state["status"] in ("unknown", "unreachable") and not state["models"]:
+        raise HTTPException(status_code=503, detail=f"Error fetching models: {state['error']}")
+    owner = "deepseek" if state["backend"] == "deepseek" else "ollama"
+    models = [{"id": name, "object": "model", "created": 0, "owned_by": owner} for name in state["models"]]
+    age = backend_monitor.age()
+    return {
+        "object": "list",
+        "data": models,
+        "age_seconds": round(age, 3) if age is not None else None,
+        "stale": backend_monitor.is_stale()
+    }
 
 if __name__ == "__main__":
     import uvicorn